@@ -0,0 +1,195 @@
+import threading
+import collections
+from textwrap import dedent
+
+from .db import get_db_engine
+
+
+BLOCKLIST_TABLES = {
+    t: t for t in [
+        'smoove_blocklist',
+        'aggregation_candidates',
+        'aggregation_positions',
+        'aggregation_candidate_positions',
+    ]
+}
+# tables used for blocking emails
+EMAIL_BLOCKLIST_TABLES = ['smoove_blocklist']
+
+# the index is loaded once per run and shared by all the callers
+index_lock = threading.Lock()
+index = None
+
+
+def normalize_id(value):
+    return value.strip() if value else None
+
+
+def normalize_email(value):
+    return value.strip().lower() if value else None
+
+
+class BlocklistIndex:
+    # normalized sets of blocked values, the block reasons are counted in counters
+
+    def __init__(self, candidate_id_position_ids=(), candidate_ids=(), position_ids=(), emails=()):
+        self.candidate_id_position_ids = set(candidate_id_position_ids)
+        self.candidate_ids = set(candidate_ids)
+        self.position_ids = set(position_ids)
+        self.emails = set(emails)
+        self.counters = collections.Counter()
+
+    @classmethod
+    def load(cls, log, emails_only=False):
+        # if emails_only is set, only the email blocklist tables are loaded
+        with get_db_engine().connect() as conn:
+            with conn.begin():
+                blocklist_index = cls(emails=(
+                    normalize_email(row.email)
+                    for row in conn.execute(f'select email from {BLOCKLIST_TABLES["smoove_blocklist"]}')
+                    if normalize_email(row.email)
+                ))
+                if not emails_only:
+                    blocklist_index.candidate_id_position_ids.update(
+                        (normalize_id(row.candidate_id), normalize_id(row.position_id))
+                        for row in conn.execute(f'''select "Candidate_id" candidate_id, "Position_id" position_id from {BLOCKLIST_TABLES['aggregation_candidate_positions']} where "Remove" = 'TRUE' ''')
+                        if normalize_id(row.candidate_id) and normalize_id(row.position_id)
+                    )
+                    blocklist_index.candidate_ids.update(
+                        normalize_id(row.candidate_id)
+                        for row in conn.execute(f'''select "Candidate_id" candidate_id from {BLOCKLIST_TABLES['aggregation_candidates']} where "Remove_can" = 'TRUE' ''')
+                        if normalize_id(row.candidate_id)
+                    )
+                    blocklist_index.position_ids.update(
+                        normalize_id(row.position_id)
+                        for row in conn.execute(f'''select "P_ID" position_id from {BLOCKLIST_TABLES['aggregation_positions']} where "Remove_P" = 'TRUE' ''')
+                        if normalize_id(row.position_id)
+                    )
+        if not emails_only:
+            log(f'Found {len(blocklist_index.candidate_id_position_ids)} block candidate_id_position_id')
+            log(f'Found {len(blocklist_index.candidate_ids)} block candidate_id')
+            log(f'Found {len(blocklist_index.position_ids)} block position_id')
+        log(f'Found {len(blocklist_index.emails)} smoove_blocklist_emails')
+        return blocklist_index
+
+    def get_block_reason(self, candidate_id=None, position_id=None):
+        # returns the reason the candidate / position is blocked, or None if not blocked
+        candidate_id, position_id = normalize_id(candidate_id), normalize_id(position_id)
+        if candidate_id and position_id and (candidate_id, position_id) in self.candidate_id_position_ids:
+            return 'candidate_id_position_id'
+        elif candidate_id and candidate_id in self.candidate_ids:
+            return 'candidate_id'
+        elif position_id and position_id in self.position_ids:
+            return 'position_id'
+        else:
+            return None
+
+    def is_email_blocked(self, email):
+        email = normalize_email(email)
+        return bool(email and email in self.emails)
+
+    def filter_emails(self, emails):
+        # returns the emails which are not blocked, counts the blocked emails
+        valid_emails = []
+        for email in emails:
+            if self.is_email_blocked(email):
+                self.counters['email'] += 1
+            else:
+                valid_emails.append(email)
+        return valid_emails
+
+    def filter_rows(self, rows, email_field=None):
+        # returns the rows which are not blocked, rows should have candidate_id and position_id fields
+        # if email_field is a dict of email: name, the blocked emails are removed from it but the row is kept
+        # because we might not send the email to these emails depending on other conditions later
+        valid_rows = []
+        for row in rows:
+            reason = self.get_block_reason(row.get('candidate_id'), row.get('position_id'))
+            if reason:
+                self.counters[reason] += 1
+            elif email_field and isinstance(row[email_field], dict):
+                email_names = {}
+                for email, name in row[email_field].items():
+                    if self.is_email_blocked(email):
+                        self.counters['email'] += 1
+                    else:
+                        email_names[email.strip()] = name
+                row[email_field] = email_names
+                valid_rows.append(row)
+            elif email_field and self.is_email_blocked(row[email_field]):
+                self.counters['email'] += 1
+            else:
+                valid_rows.append(row)
+        return valid_rows
+
+    def log_counters(self, log):
+        log(f'Blocked {self.counters["candidate_id_position_id"]} candidate_id_position_id, {self.counters["candidate_id"]} candidate_id, '
+            f'{self.counters["position_id"]} position_id, {self.counters["email"]} smoove emails')
+
+
+def get_sql_conditions(candidate_id_sql=None, position_id_sql=None, email_sql=None):
+    # returns a list of (reason, sql) tuples, ordered by the same precedence as BlocklistIndex.filter_rows
+    # each sql is an exists condition which is true if the row is blocked for that reason
+    # the blocklist tables trimmed id columns are derived and indexed when loaded (see load_data.DEFAULT_TABLES_SCHEMAS)
+    conditions = []
+    if candidate_id_sql and position_id_sql:
+        conditions.append(('candidate_id_position_id', dedent(f'''
+            exists (
+                select 1 from {BLOCKLIST_TABLES['aggregation_candidate_positions']} b
+                where b."Remove" = 'TRUE' and b.candidate_id = trim({candidate_id_sql}) and b.position_id = trim({position_id_sql})
+            )
+        ''').strip()))
+    if candidate_id_sql:
+        conditions.append(('candidate_id', dedent(f'''
+            exists (
+                select 1 from {BLOCKLIST_TABLES['aggregation_candidates']} b
+                where b."Remove_can" = 'TRUE' and b.candidate_id = trim({candidate_id_sql})
+            )
+        ''').strip()))
+    if position_id_sql:
+        conditions.append(('position_id', dedent(f'''
+            exists (
+                select 1 from {BLOCKLIST_TABLES['aggregation_positions']} b
+                where b."Remove_P" = 'TRUE' and b.position_id = trim({position_id_sql})
+            )
+        ''').strip()))
+    if email_sql:
+        # the smoove blocklist emails are normalized when extracted
+        conditions.append(('email', dedent(f'''
+            exists (
+                select 1 from {BLOCKLIST_TABLES['smoove_blocklist']} b
+                where b.email = lower(trim({email_sql}))
+            )
+        ''').strip()))
+    return conditions
+
+
+def get_sql_where(conditions):
+    # returns an sql to add to a where clause to exclude the blocked rows (not exists anti-joins)
+    return '\n'.join(f'and not {sql}' for reason, sql in conditions)
+
+
+def get_sql_counts_query(conditions, from_sql, with_sql=''):
+    # returns an aggregate query which counts the blocked rows per reason
+    # from_sql - the "from ... where ..." part of the rows query, without the get_sql_where exclusions
+    counts_sql = ',\n'.join(f"count(*) filter (where blocked_reason = '{reason}') {reason}" for reason, sql in conditions)
+    reason_sql = '\n'.join(f"when {sql} then '{reason}'" for reason, sql in conditions)
+    return f'''
+        {with_sql}
+        select {counts_sql}
+        from (
+            select case {reason_sql} end blocked_reason
+            {from_sql}
+        ) t
+    '''
+
+
+def get_index(log, emails_only=False):
+    # returns the shared index, an emails only index is not shared
+    global index
+    if emails_only:
+        return BlocklistIndex.load(log, emails_only=True)
+    with index_lock:
+        if index is None:
+            index = BlocklistIndex.load(log)
+        return index
@@ -62,11 +62,17 @@ def extract_data(**kwargs):
 @click.option('--extract', is_flag=True)
 @click.option('--only-table-name')
 @click.option('--only-table-types')
+@click.option('--loader', type=click.Choice(['copy', 'dataflows']))
+@click.option('--jobs', type=int, default=1, help='Number of tables to load concurrently')
+@click.option('--force', is_flag=True, help='Load tables even if their content did not change')
+@click.option('--pipeline', is_flag=True, help='Load tables while extracting other tables (requires --extract)')
+@click.option('--stream', is_flag=True, help='Stream extracted rows directly to the DB, google sheets are read in pages (requires --extract)')
+@click.option('--skip-csv-snapshot', is_flag=True, help='Do not save csv snapshots of the streamed tables')
 def load_data(**kwargs):
     from . import load_data
     with processing_record() as log:
         for table_name in load_data.main(log, **kwargs):
-            log(f'Loaded {table_name}')
+            log(f'Processed {table_name}')
     print("OK")
 
 
@@ -77,6 +83,7 @@ def load_data(**kwargs):
 @click.option('--save-to-gcs', is_flag=True)
 @click.option('--force', is_flag=True)
 @click.option('--slow-network', is_flag=True)
+@click.option('--fetch-mode', type=click.Choice(['print', 'cdp']), help='CV fetch mode (default: DOWNLOAD_POSITION_CANDIDATE_CV_FETCH_MODE)')
 def download_position_candidate_cv(**kwargs):
     from . import download_position_candidate_cv
     with processing_record() as log:
@@ -89,6 +96,9 @@ def download_position_candidate_cv(**kwargs):
 @click.option('--headless', is_flag=True)
 @click.option('--save-to-gcs', is_flag=True)
 @click.option('--force', is_flag=True)
+@click.option('--skip-download-errors', is_flag=True)
+@click.option('--jobs', type=int, help='Number of browser workers (default: DOWNLOAD_POSITION_CANDIDATE_CV_JOBS)')
+@click.option('--fetch-mode', type=click.Choice(['print', 'cdp']), help='CV fetch mode (default: DOWNLOAD_POSITION_CANDIDATE_CV_FETCH_MODE)')
 def download_position_candidate_cv_multi(**kwargs):
     kwargs['position_candidate_ids'] = json.loads(kwargs.pop('position_candidate_ids_json'))
     from . import download_position_candidate_cv
@@ -106,8 +116,13 @@ def download_position_candidate_cv_multi(**kwargs):
 @click.option('--test-email-update-db', is_flag=True)
 @click.option('--only-candidate-position-ids')
 @click.option('--ensure-updated-tables', is_flag=True)
+@click.option('--ensure-updated-tables-jobs', type=int, default=1, help='Number of tables to update concurrently')
 @click.option('--with-sent', is_flag=True)
 @click.option('--skip-download-cvs', is_flag=True)
+@click.option('--skip-if-unchanged', is_flag=True, help='Skip if the input tables did not change since the last run')
+@click.option('--blocklist-in-sql', is_flag=True, help='Apply the candidate / position blocklists in the query instead of loading them')
+@click.option('--batch-personalizations', is_flag=True, help='Send mails with the same sender and template and without attachments in a single request')
+@click.option('--stream-rows', is_flag=True, help='Stream the rows from the DB and send the mails while fetching (not supported for dry run / new_position)')
 def send_candidate_offers_mailing(**kwargs):
     only_candidate_position_ids = kwargs.pop('only_candidate_position_ids')
     kwargs['only_candidate_position_ids'] = json.loads(only_candidate_position_ids) if only_candidate_position_ids else None
@@ -121,6 +136,8 @@ def send_candidate_offers_mailing(**kwargs):
 @click.option('--only-emails')
 @click.option('--limit', type=int)
 @click.option('--debug', is_flag=True)
+@click.option('--skip-if-unchanged', is_flag=True, help='Skip if the input tables did not change since the last run')
+@click.option('--skip-blocklisted', is_flag=True, help='Skip candidates with emails in the smoove blocklist')
 def update_smoove_candidates_mailing_list(**kwargs):
     from . import update_smoove_candidates_mailing_list
     with processing_record() as log:
@@ -132,6 +149,8 @@ def update_smoove_candidates_mailing_list(**kwargs):
 @click.option('--only-emails')
 @click.option('--limit', type=int)
 @click.option('--debug', is_flag=True)
+@click.option('--skip-if-unchanged', is_flag=True, help='Skip if the input tables did not change since the last run')
+@click.option('--skip-blocklisted', is_flag=True, help='Skip candidates with emails in the smoove blocklist')
 def update_sender_candidates_mailing_list(**kwargs):
     from . import update_sender_candidates_mailing_list
     with processing_record() as log:
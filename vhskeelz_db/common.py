@@ -1,3 +1,6 @@
+import time
+import threading
+
 from urllib3.util import Retry
 from requests import Session
 from requests.adapters import HTTPAdapter
@@ -15,3 +18,26 @@ def requests_session_retry(total=10, backoff_factor=2, backoff_max=60, status_fo
     s.mount('https://', HTTPAdapter(max_retries=retries))
     s.mount('http://', HTTPAdapter(max_retries=retries))
     return s
+
+
+class TokenBucket:
+    # thread-safe token bucket rate limiter, allows bursts of up to capacity requests and rate requests per second on average
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
@@ -13,9 +13,17 @@ EXTRACT_DATA_USERNAME = os.environ.get('EXTRACT_DATA_USERNAME')
 EXTRACT_DATA_PASSWORD = os.environ.get('EXTRACT_DATA_PASSWORD')
 EXTRACT_DATA_TABLES = json.loads(os.environ.get('EXTRACT_DATA_TABLES', '{}'))
 EXTRACT_DATA_PATH = os.path.join(DATA_DIR, 'extract_data')
+# copy - stream the csv to postgres using COPY, dataflows - load using dataflows dump_to_sql
+LOAD_DATA_LOADER = os.environ.get('LOAD_DATA_LOADER') or 'copy'
 
 SERVICE_ACCOUNT_FILE = os.environ.get('SERVICE_ACCOUNT_FILE')
 
+# number of spreadsheets to fetch in parallel and the Sheets API read requests quota (per minute per user)
+GOOGLE_SHEETS_EXTRACT_CONCURRENCY = int(os.environ.get('GOOGLE_SHEETS_EXTRACT_CONCURRENCY') or '4')
+GOOGLE_SHEETS_READ_REQUESTS_PER_MINUTE = int(os.environ.get('GOOGLE_SHEETS_READ_REQUESTS_PER_MINUTE') or '60')
+# number of rows read per request when streaming google sheets (load_data --stream)
+GOOGLE_SHEETS_STREAM_PAGE_ROWS = int(os.environ.get('GOOGLE_SHEETS_STREAM_PAGE_ROWS') or '5000')
+
 PGSQL_USER = os.environ.get('PGSQL_USER', 'postgres')
 PGSQL_PASSWORD = os.environ.get('PGSQL_PASSWORD', '123456')
 PGSQL_HOST = os.environ.get('PGSQL_HOST', 'localhost')
@@ -29,6 +37,7 @@ PROCESSING_RECORD_CONTEXT_IGNORE_EXCEPTIONS_IF_RECENT_SUCCESS = os.environ.get('
 PROCESSING_RECORD_CONTEXT_IGNORE_EXCEPTIONS_IF_RECENT_SUCCESS_INTERVAL = os.environ.get('PROCESSING_RECORD_CONTEXT_IGNORE_EXCEPTIONS_IF_RECENT_SUCCESS_INTERVAL') or '2 day'
 
 SMOOVE_API_KEY = os.environ.get('SMOOVE_API_KEY')
+SMOOVE_API_PAGE_SIZE = int(os.environ.get('SMOOVE_API_PAGE_SIZE') or '100')
 SENDER_API_TOKEN = os.environ.get('SENDER_API_TOKEN')
 SENDGRID_API_KEY = os.environ.get('SENDGRID_API_KEY')
 SENDGRID_UNSUSCRIBE_GROUP_ID = os.environ.get('SENDGRID_UNSUSCRIBE_GROUP_ID')
@@ -36,11 +45,37 @@ SENDGRID_UNSUSCRIBE_GROUP_ID = os.environ.get('SENDGRID_UNSUSCRIBE_GROUP_ID')
 CANDIDATE_POSITION_CV_URL_TEMPLATE = os.environ.get('CANDIDATE_POSITION_CV_URL_TEMPLATE')
 SKEELZ_USERNAME = os.environ.get('SKEELZ_USERNAME')
 SKEELZ_PASSWORD = os.environ.get('SKEELZ_PASSWORD')
+# number of browser workers used to download position candidate CVs in parallel
+DOWNLOAD_POSITION_CANDIDATE_CV_JOBS = int(os.environ.get('DOWNLOAD_POSITION_CANDIDATE_CV_JOBS') or '4')
+# print - click the export button in a non-headless browser, cdp - render the CV page to PDF in a headless browser
+DOWNLOAD_POSITION_CANDIDATE_CV_FETCH_MODE = os.environ.get('DOWNLOAD_POSITION_CANDIDATE_CV_FETCH_MODE') or 'print'
+# keep the chrome profiles between runs, so that the Skeelz login is kept, each concurrent browser uses its own profile slot
+CHROME_PERSISTENT_PROFILE = os.environ.get('CHROME_PERSISTENT_PROFILE') != 'false'
+CHROME_PERSISTENT_PROFILE_SLOTS = int(os.environ.get('CHROME_PERSISTENT_PROFILE_SLOTS') or '8')
+# a new login is done if the Skeelz session tokens expire in less than this number of seconds
+SKEELZ_SESSION_MIN_TTL_SECONDS = int(os.environ.get('SKEELZ_SESSION_MIN_TTL_SECONDS') or '600')
+# number of skeelz exports to download in parallel and the download streaming chunk size (bytes)
+SKEELZ_EXPORT_DOWNLOAD_CONCURRENCY = int(os.environ.get('SKEELZ_EXPORT_DOWNLOAD_CONCURRENCY') or '4')
+SKEELZ_EXPORT_DOWNLOAD_CHUNK_SIZE = int(os.environ.get('SKEELZ_EXPORT_DOWNLOAD_CHUNK_SIZE') or str(1024 * 1024))
 
 CANDIDATE_OFFERS_MAILING_CONFIG = json.loads(os.environ.get('CANDIDATE_OFFERS_MAILING_CONFIG', '{}'))
 POSITION_DETAILS_URL_TEMPLATE = os.environ.get('POSITION_DETAILS_URL_TEMPLATE')
+# the sent mailing statuses are buffered and written to the DB when reaching the max number of rows / seconds since the last write
+CANDIDATE_OFFERS_MAILING_STATUS_FLUSH_ROWS = int(os.environ.get('CANDIDATE_OFFERS_MAILING_STATUS_FLUSH_ROWS') or '500')
+CANDIDATE_OFFERS_MAILING_STATUS_FLUSH_SECONDS = int(os.environ.get('CANDIDATE_OFFERS_MAILING_STATUS_FLUSH_SECONDS') or '30')
+# number of rows fetched at a time and prepared as mail data together when streaming the mailing rows
+CANDIDATE_OFFERS_MAILING_STREAM_CHUNK_ROWS = int(os.environ.get('CANDIDATE_OFFERS_MAILING_STREAM_CHUNK_ROWS') or '1000')
+# max number of concurrent SendGrid send requests and the average send requests rate limit
+SENDGRID_SEND_CONCURRENCY = int(os.environ.get('SENDGRID_SEND_CONCURRENCY') or '4')
+SENDGRID_SEND_REQUESTS_PER_SECOND = float(os.environ.get('SENDGRID_SEND_REQUESTS_PER_SECOND') or '10')
+# max number of recipients (to + bcc of all personalizations) in a single batched SendGrid request, SendGrid allows up to 1000
+SENDGRID_MAX_BATCH_RECIPIENTS = int(os.environ.get('SENDGRID_MAX_BATCH_RECIPIENTS') or '100')
 
 GCS_BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME')
+# max size of the local CV cache, least recently used CVs are evicted
+CV_CACHE_MAX_SIZE_MB = int(os.environ.get('CV_CACHE_MAX_SIZE_MB') or '1024')
+# max number of concurrent GCS uploads / downloads
+GCS_TRANSFER_CONCURRENCY = int(os.environ.get('GCS_TRANSFER_CONCURRENCY') or '8')
 
 SALESFORCE_USERNAME = os.environ.get('SALESFORCE_USERNAME')
 # SALESFORCE_PASSWORD = os.environ.get('SALESFORCE_PASSWORD')
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import base64
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from . import config, gcs
+
+
+# CVs are stored by their content md5 hash, the index maps the position_candidate key to the stored content and its GCS metadata
+# the cache size is bounded by CV_CACHE_MAX_SIZE_MB, least recently used contents are evicted first
+CACHE_DIRECTORY = os.path.join(config.DATA_DIR, 'cv_cache')
+OBJECTS_DIRECTORY = os.path.join(CACHE_DIRECTORY, 'objects')
+INDEX_FILENAME = os.path.join(CACHE_DIRECTORY, 'index.json')
+# CVs were downloaded to this directory by the mailing before the cache was added, they are used if not in the cache
+LEGACY_CV_DIRECTORY = os.path.join(config.DATA_DIR, 'candidate_offers_interested_mailing', 'cv')
+
+index_lock = threading.RLock()
+index = None
+# contents used in this run are not evicted, because the caller may still use the cached file (e.g. as a mail attachment)
+used_content_hashes = set()
+
+
+def get_key(position_id, candidate_id):
+    return f'{position_id}_{candidate_id}'
+
+
+def get_blob_name(position_id, candidate_id):
+    return f'cv/{position_id}_{candidate_id}.pdf'
+
+
+def get_object_filename(content_hash):
+    return os.path.join(OBJECTS_DIRECTORY, f'{content_hash}.pdf')
+
+
+def get_file_md5_hash(file_path):
+    # returns the base64 md5 hash, same format as GCS blob md5_hash
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode()
+
+
+def get_blob_content_hash(blob):
+    return base64.b64decode(blob.md5_hash).hex() if blob.md5_hash else None
+
+
+def get_index():
+    global index
+    with index_lock:
+        if index is None:
+            if os.path.exists(INDEX_FILENAME):
+                with open(INDEX_FILENAME) as f:
+                    index = json.load(f)
+            else:
+                index = {'keys': {}, 'objects': {}}
+        return index
+
+
+def save_index():
+    with index_lock:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        with open(f'{INDEX_FILENAME}.tmp', 'w') as f:
+            json.dump(get_index(), f)
+        os.replace(f'{INDEX_FILENAME}.tmp', INDEX_FILENAME)
+
+
+def evict(log=None):
+    max_size = config.CV_CACHE_MAX_SIZE_MB * 1024 * 1024
+    with index_lock:
+        objects = get_index()['objects']
+        total_size = sum(o['size'] for o in objects.values())
+        for content_hash, o in sorted(objects.items(), key=lambda item: item[1]['last_used']):
+            if total_size <= max_size:
+                break
+            if content_hash in used_content_hashes:
+                continue
+            if os.path.exists(get_object_filename(content_hash)):
+                os.unlink(get_object_filename(content_hash))
+            del objects[content_hash]
+            total_size -= o['size']
+        keys = get_index()['keys']
+        for key in [key for key, entry in keys.items() if entry['content_hash'] not in objects]:
+            del keys[key]
+        if log:
+            log(f'CV cache size: {total_size / 1024 / 1024:.1f}MB ({len(objects)} CVs)')
+
+
+def get_cached_filename(key, blob):
+    # returns the cached file name if the cache entry matches the blob generation and md5 hash
+    # the last used time is updated only in memory, the index is saved after all the CVs were fetched (see prefetch)
+    with index_lock:
+        entry = get_index()['keys'].get(key)
+        if (
+            entry
+            and entry['generation'] == blob.generation
+            and (not blob.md5_hash or entry['content_hash'] == get_blob_content_hash(blob))
+            and os.path.exists(get_object_filename(entry['content_hash']))
+        ):
+            get_index()['objects'][entry['content_hash']]['last_used'] = time.time()
+            used_content_hashes.add(entry['content_hash'])
+            return get_object_filename(entry['content_hash'])
+    return None
+
+
+def put_file(key, file_path, blob, move=False):
+    # stores the file in the cache for the given key and GCS blob, returns the cached file name
+    # the cached content hash is the md5 of the file, which is verified against the blob md5 hash (if available)
+    md5_hash = get_file_md5_hash(file_path)
+    assert not blob.md5_hash or blob.md5_hash == md5_hash, f'md5 hash mismatch for {key}: {md5_hash} != {blob.md5_hash}'
+    content_hash = base64.b64decode(md5_hash).hex()
+    object_filename = get_object_filename(content_hash)
+    with index_lock:
+        if not os.path.exists(object_filename):
+            os.makedirs(OBJECTS_DIRECTORY, exist_ok=True)
+            (shutil.move if move else shutil.copyfile)(file_path, f'{object_filename}.tmp')
+            os.replace(f'{object_filename}.tmp', object_filename)
+        elif move:
+            os.unlink(file_path)
+        get_index()['objects'][content_hash] = {'size': os.path.getsize(object_filename), 'last_used': time.time()}
+        get_index()['keys'][key] = {'generation': blob.generation, 'content_hash': content_hash}
+        used_content_hashes.add(content_hash)
+        evict()
+        save_index()
+    return object_filename
+
+
+def get_cached_cv(position_id, candidate_id):
+    # returns the cached file name without validating against GCS, or None if not cached
+    with index_lock:
+        entry = get_index()['keys'].get(get_key(position_id, candidate_id))
+        if entry and os.path.exists(get_object_filename(entry['content_hash'])):
+            used_content_hashes.add(entry['content_hash'])
+            return get_object_filename(entry['content_hash'])
+    legacy_filename = os.path.join(LEGACY_CV_DIRECTORY, f'{get_key(position_id, candidate_id)}.pdf')
+    return legacy_filename if os.path.exists(legacy_filename) else None
+
+
+def get_cv(log, position_id, candidate_id):
+    # returns the local file name of the CV, downloading from GCS only if the cached CV doesn't match the GCS metadata
+    # returns None if the CV doesn't exist in GCS
+    key = get_key(position_id, candidate_id)
+    blob = gcs.get_blob(get_blob_name(position_id, candidate_id))
+    if blob is None:
+        return None
+    cached_filename = get_cached_filename(key, blob)
+    if cached_filename:
+        return cached_filename
+    log(f'Downloading CV from GCS: {blob.name}')
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=CACHE_DIRECTORY) as tmpdir:
+        file_path = os.path.join(tmpdir, f'{key}.pdf')
+        gcs.download_blob_to_filename(blob, file_path)
+        return put_file(key, file_path, blob, move=True)
+
+
+def prefetch(log, position_candidate_ids):
+    # gets the CVs concurrently, returns a dict of (position_id, candidate_id): local file name (None if the CV doesn't exist in GCS)
+    position_candidate_ids = set(position_candidate_ids)
+    log(f'Prefetching {len(position_candidate_ids)} CVs')
+    with gcs.get_transfer_executor() as executor:
+        futures = {
+            position_candidate_id: executor.submit(get_cv, log, *position_candidate_id)
+            for position_candidate_id in position_candidate_ids
+        }
+    # saves the last used times of the cache hits
+    save_index()
+    return {position_candidate_id: future.result() for position_candidate_id, future in futures.items()}
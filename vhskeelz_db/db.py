@@ -1,4 +1,8 @@
+import io
+import csv
 import time
+import itertools
+import threading
 import contextlib
 from urllib.parse import quote_plus
 
@@ -33,20 +37,73 @@ def conn_transaction_sql_handler(conn):
         'last_commit': time.time(),
         'sqls': [],
     }
+    # sql_execute may be called from multiple threads (e.g. processing_record log when loading tables concurrently)
+    lock = threading.Lock()
 
     def sql_execute(sql, force_commit=False):
-        if state['first_execute'] is None:
-            state['first_execute'] = time.time()
-        if time.time() - state['first_execute'] > 60 * 60 * 5:
-            force_commit = True
         assert isinstance(sql, str), f'sql_execute argument must be a string, not {type(sql)}: {sql}'
-        state['sqls'].append(sql)
-        if force_commit or time.time() - state['last_commit'] > 120:
-            execute_sqls(conn, state['sqls'])
-            state['sqls'] = []
-            state['last_commit'] = time.time()
+        with lock:
+            if state['first_execute'] is None:
+                state['first_execute'] = time.time()
+            if time.time() - state['first_execute'] > 60 * 60 * 5:
+                force_commit = True
+            state['sqls'].append(sql)
+            if force_commit or time.time() - state['last_commit'] > 120:
+                execute_sqls(conn, state['sqls'])
+                state['sqls'] = []
+                state['last_commit'] = time.time()
 
     try:
         yield sql_execute
     finally:
-        execute_sqls(conn, state['sqls'])
+        with lock:
+            execute_sqls(conn, state['sqls'])
+
+
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class CsvRowsReader:
+    # file-like object which encodes rows to csv on demand, used as input for psycopg2 copy_expert
+
+    def __init__(self, rows, chunk_num_rows=1000):
+        self.rows = iter(rows)
+        self.chunk_num_rows = chunk_num_rows
+        self.buffer = b''
+
+    def get_next_chunk(self):
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerows(itertools.islice(self.rows, self.chunk_num_rows))
+        return out.getvalue().encode()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.get_next_chunk()
+            if not chunk:
+                break
+            self.buffer += chunk
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def recreate_text_table_copy(conn, table_name, field_names, rows, copy_buffer_size=1024*1024):
+    # empty values are loaded as nulls, same as the dataflows dump_to_sql loading
+    fields_sql = ', '.join(quote_identifier(field_name) for field_name in field_names)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(
+            f'drop table if exists {table_name};\n'
+            f'create table {table_name} ({", ".join(f"{quote_identifier(field_name)} text" for field_name in field_names)});'
+        )
+        cursor.copy_expert(
+            f'copy {table_name} ({fields_sql}) from stdin with (format csv, force_null ({fields_sql}))',
+            CsvRowsReader(rows), size=copy_buffer_size
+        )
+        return cursor.rowcount
+    finally:
+        cursor.close()
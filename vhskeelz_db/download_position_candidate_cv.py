@@ -1,14 +1,19 @@
 import os
 import time
 import json
+import fcntl
+import queue
+import base64
 import shutil
+import functools
+import threading
+import collections
 import datetime
 import tempfile
 import traceback
 from contextlib import contextmanager
 
 
-import google.cloud.storage
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -16,15 +21,52 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
 
 
-from . import config
+from . import config, gcs, cv_cache, fswatch
 
 
 DOWNLOAD_DIRECTORY = os.path.join(config.DATA_DIR, 'download_position_candidate_cv')
 SELENIUM_DEBUG_DUMPS_DIRECTORY = os.path.join(DOWNLOAD_DIRECTORY, 'selenium_debug_dumps')
+CHROME_PROFILES_DIRECTORY = os.path.join(config.DATA_DIR, 'chrome_profiles')
 
+# print - click the export button and capture the kiosk print output, requires a non-headless browser
+# cdp - render the CV page to PDF using the Chrome DevTools Protocol, runs headless and reuses the shared Skeelz session cookies
+FETCH_MODES = ['print', 'cdp']
+EXPORT_BUTTON_XPATH = "//p[contains(., 'ייצוא פרטים')]"
+LOGIN_HEADER_XPATH = "//h2[contains(., 'לכניסת מגייסים')]"
 
-def get_driver(download_path, headless, proxy_server):
-    assert not headless, 'sorry, headless is not supported for printing'
+
+@contextmanager
+def persistent_profile_contextmanager(log=print):
+    # yields a persistent chrome profile directory which is locked for the lifetime of the context
+    # there are CHROME_PERSISTENT_PROFILE_SLOTS profiles to allow concurrent browsers (e.g. multiple download workers or runs)
+    # yields None if persistent profiles are disabled or all the profiles are locked, in which case a fresh profile should be used
+    if config.CHROME_PERSISTENT_PROFILE:
+        os.makedirs(CHROME_PROFILES_DIRECTORY, exist_ok=True)
+        for slot in range(config.CHROME_PERSISTENT_PROFILE_SLOTS):
+            lock_file = open(os.path.join(CHROME_PROFILES_DIRECTORY, f'{slot}.lock'), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            try:
+                user_data_path = os.path.join(CHROME_PROFILES_DIRECTORY, str(slot))
+                os.makedirs(user_data_path, exist_ok=True)
+                # the profile is locked by us, so chrome singleton files can only be leftovers from a chrome process which crashed
+                for filename in ['SingletonLock', 'SingletonSocket', 'SingletonCookie']:
+                    if os.path.lexists(os.path.join(user_data_path, filename)):
+                        os.unlink(os.path.join(user_data_path, filename))
+                yield user_data_path
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        log('All persistent chrome profiles are locked, using a fresh profile')
+    yield None
+
+
+def get_driver(download_path, headless, proxy_server, fetch_mode='print', user_data_path=None):
+    assert fetch_mode != 'print' or not headless, 'sorry, headless is not supported for printing'
     chrome_options = Options()
     print_settings = {
         "recentDestinations": [{
@@ -38,7 +80,8 @@ def get_driver(download_path, headless, proxy_server):
         "isLandscapeEnabled": True
     }
     os.makedirs(download_path, exist_ok=True)
-    # chrome_options.add_argument(f"user-data-dir={user_data_path}")
+    if user_data_path:
+        chrome_options.add_argument(f"user-data-dir={user_data_path}")
     chrome_options.add_argument('--enable-print-browser')
     chrome_options.add_experimental_option("prefs", {
         "printing.print_preview_sticky_settings.appState": json.dumps(print_settings),
@@ -52,7 +95,7 @@ def get_driver(download_path, headless, proxy_server):
     chrome_options.add_argument("--kiosk-printing")
     # chrome_options.add_argument("window-size=1200x1600")
     if headless:
-        chrome_options.headless = True
+        chrome_options.add_argument("--headless=new")
     if proxy_server:
         print(f'Using proxy server: {proxy_server}')
         chrome_options.add_argument(f'--proxy-server={proxy_server}')
@@ -61,8 +104,15 @@ def get_driver(download_path, headless, proxy_server):
 
 
 @contextmanager
-def driver_contextmanager(download_path, headless, proxy_server, set_trace, slow_network=False):
-    driver = get_driver(download_path, headless, proxy_server)
+def driver_contextmanager(download_path, headless, proxy_server, set_trace, slow_network=False, fetch_mode='print'):
+    with persistent_profile_contextmanager() as user_data_path:
+        with _driver_contextmanager(download_path, headless, proxy_server, set_trace, slow_network, fetch_mode, user_data_path) as driver:
+            yield driver
+
+
+@contextmanager
+def _driver_contextmanager(download_path, headless, proxy_server, set_trace, slow_network, fetch_mode, user_data_path):
+    driver = get_driver(download_path, headless, proxy_server, fetch_mode=fetch_mode, user_data_path=user_data_path)
     driver.execute_cdp_cmd('Network.enable', {})
     if slow_network:
         driver.execute_cdp_cmd('Network.emulateNetworkConditions', {
@@ -96,9 +146,18 @@ def debug_dump(driver, basename='debug_dump'):
     print(f'browser screenshot and html saved to {screenshot_filename} and {pagedump_filename}')
 
 
+def is_logged_in(driver):
+    # the persistent profile keeps the session cookies, login is not needed if they are not expired
+    from . import skeelz_session
+    return skeelz_session.is_valid_cookies(driver.get_cookies())
+
+
 def login(log, driver):
+    if is_logged_in(driver):
+        log("Already logged in")
+        return
     log("Start Login")
-    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//h2[contains(., 'לכניסת מגייסים')]"))).click()
+    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, LOGIN_HEADER_XPATH))).click()
     WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//button[contains(., 'הרשאת כניסה')]"))).click()
     WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.NAME, 'identifier'))).send_keys(config.SKEELZ_USERNAME)
     WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.NAME, 'credentials.passcode'))).send_keys(config.SKEELZ_PASSWORD)
@@ -107,82 +166,296 @@ def login(log, driver):
 
 
 def upload_to_gcs(source_file_name, destination_blob_name):
-    storage_client = google.cloud.storage.Client.from_service_account_json(config.SERVICE_ACCOUNT_FILE)
-    bucket = storage_client.bucket(config.GCS_BUCKET_NAME)
-    blob = bucket.blob(destination_blob_name)
-    with open(source_file_name, "rb") as f:
-        blob.upload_from_file(f)
+    return gcs.upload_file(source_file_name, destination_blob_name)
 
 
 def check_gcs_blob_exists(destination_blob_name):
-    storage_client = google.cloud.storage.Client.from_service_account_json(config.SERVICE_ACCOUNT_FILE)
-    bucket = storage_client.bucket(config.GCS_BUCKET_NAME)
-    blob = bucket.blob(destination_blob_name)
-    return blob.exists()
-
-
-def download_from_gcs(source_blob_name, destination_file_name):
-    storage_client = google.cloud.storage.Client.from_service_account_json(config.SERVICE_ACCOUNT_FILE)
-    bucket = storage_client.bucket(config.GCS_BUCKET_NAME)
-    blob = bucket.blob(source_blob_name)
-    if blob.exists():
-        blob.download_to_filename(destination_file_name)
-        return True
-    else:
-        return False
+    # single blob lookup, the multi download checks the existing blobs using the cached listing (see iterate_multi)
+    return gcs.blob_exists(destination_blob_name, use_listing=False)
+
+
+def set_session_cookies(driver, cookies):
+    # cookies are set using CDP so that it's not needed to navigate to the cookies domain first
+    for cookie in cookies:
+        params = {k: cookie[k] for k in ['name', 'value', 'domain', 'path', 'secure', 'httpOnly'] if k in cookie}
+        if cookie.get('expiry'):
+            params['expires'] = cookie['expiry']
+        if cookie.get('sameSite') in ['Strict', 'Lax', 'None']:
+            params['sameSite'] = cookie['sameSite']
+        driver.execute_cdp_cmd('Network.setCookie', params)
+
+
+def login_session(log, driver):
+    # login for the cdp fetch mode, should be called before navigating to the CV page
+    # the shared Skeelz session cookies are used, login using the driver is done only if they are missing or expired
+    from . import skeelz_session
+    cookies = skeelz_session.get_cookies(log, driver=driver)
+    set_session_cookies(driver, cookies)
+    return cookies
 
 
-def download(log, driver, download_path, position_id, candidate_id, save_to_gcs=False):
-    elt = WebDriverWait(driver, 15).until(EC.presence_of_element_located((By.XPATH, "//p[contains(., 'ייצוא פרטים')]")))
-    time.sleep(2)
-    elt.click()
-    WebDriverWait(driver, 20).until(lambda _: any(filename.endswith('.pdf') for filename in os.listdir(download_path)))
+def is_login_page(driver):
+    return len(driver.find_elements(By.XPATH, LOGIN_HEADER_XPATH)) > 0
+
+
+class Timings:
+    # records the duration of each step, for logging
+
+    def __init__(self):
+        self.durations = {}
+        self.last_time = time.monotonic()
+
+    def record(self, step):
+        now = time.monotonic()
+        self.durations[step] = now - self.last_time
+        self.last_time = now
+
+    def __str__(self):
+        return ' '.join(f'{step}={duration:.2f}s' for step, duration in self.durations.items())
+
+
+def wait_page_ready(driver):
+    # the export button is rendered only after the CV details were loaded
+    elt = WebDriverWait(driver, 15).until(EC.element_to_be_clickable((By.XPATH, EXPORT_BUTTON_XPATH)))
+    WebDriverWait(driver, 15).until(lambda _: driver.execute_script('return document.readyState') == 'complete')
+    return elt
+
+
+def download_print(log, driver, download_path, timings):
+    elt = wait_page_ready(driver)
+    timings.record('page_ready')
+    # the watcher is started before the click, the print is detected when the pdf file is closed after writing
+    with fswatch.DirectoryWatcher(download_path, '.pdf') as watcher:
+        elt.click()
+        timings.record('click')
+        filename = watcher.wait(20)
+    timings.record('file_ready')
     filenames = [filename for filename in os.listdir(download_path) if filename.endswith('.pdf')]
-    assert len(filenames) == 1
-    filename = filenames[0]
+    assert filenames == [filename], filenames
+    return filename
+
+
+def download_cdp(log, driver, download_path, position_id, candidate_id, timings):
+    wait_page_ready(driver)
+    timings.record('page_ready')
+    res = driver.execute_cdp_cmd('Page.printToPDF', {
+        'landscape': True,
+        'displayHeaderFooter': False,
+        'printBackground': True,
+    })
+    filename = f'{position_id}_{candidate_id}.pdf'
+    with open(os.path.join(download_path, filename), 'wb') as f:
+        f.write(base64.b64decode(res['data']))
+    timings.record('file_ready')
+    return filename
+
+
+def download(log, driver, download_path, position_id, candidate_id, save_to_gcs=False, fetch_mode='print', timings=None):
+    # timings is updated with the duration of the download steps
+    timings = timings or Timings()
+    if fetch_mode == 'cdp':
+        filename = download_cdp(log, driver, download_path, position_id, candidate_id, timings)
+    else:
+        filename = download_print(log, driver, download_path, timings)
     log(f"Downloaded CV filename: {filename}")
     os.makedirs(DOWNLOAD_DIRECTORY, exist_ok=True)
-    target_filename = os.path.join(DOWNLOAD_DIRECTORY, f'{position_id}_{candidate_id}.pdf')
+    target_filename = get_target_filename(position_id, candidate_id)
     shutil.move(os.path.join(download_path, filename), target_filename)
     log(f'CV downloaded to {target_filename}')
     if save_to_gcs:
-        upload_to_gcs(target_filename, f'cv/{position_id}_{candidate_id}.pdf')
-        log(f'CV uploaded to GCS: cv/{position_id}_{candidate_id}.pdf')
+        upload_cv(log, position_id, candidate_id, timings)
     return filename
 
 
-def main_multi(log, position_candidate_ids, headless=False, proxy_server=None, set_trace=False, save_to_gcs=False, force=False, skip_download_errors=False):
-    with tempfile.TemporaryDirectory() as download_path:
-        with driver_contextmanager(download_path, headless, proxy_server, set_trace) as driver:
-            is_loggedin = False
-            for position_id, candidate_id in position_candidate_ids:
-                if not force and check_gcs_blob_exists(f'cv/{position_id}_{candidate_id}.pdf'):
-                    log(f'CV already exists in GCS: cv/{position_id}_{candidate_id}.pdf')
-                else:
-                    url = config.CANDIDATE_POSITION_CV_URL_TEMPLATE.format(position_id=position_id, candidate_id=candidate_id)
-                    log(f"Downloading CV from URL {url}")
-                    driver.get(url)
-                    if not is_loggedin:
-                        login(log, driver)
-                        is_loggedin = True
+def get_target_filename(position_id, candidate_id):
+    return os.path.join(DOWNLOAD_DIRECTORY, f'{position_id}_{candidate_id}.pdf')
+
+
+def upload_cv(log, position_id, candidate_id, timings=None):
+    start_time = time.monotonic()
+    target_filename = get_target_filename(position_id, candidate_id)
+    blob = upload_to_gcs(target_filename, f'cv/{position_id}_{candidate_id}.pdf')
+    if timings:
+        timings.record('upload')
+    log(f'CV uploaded to GCS: cv/{position_id}_{candidate_id}.pdf (upload={time.monotonic() - start_time:.2f}s)')
+    # the uploaded CV is moved to the size bounded CV cache, so it won't be downloaded again by the mailing
+    cv_cache.put_file(cv_cache.get_key(position_id, candidate_id), target_filename, blob, move=True)
+
+
+def clear_download_path(download_path):
+    for filename in os.listdir(download_path):
+        os.unlink(os.path.join(download_path, filename))
+
+
+def download_worker(log, worker_num, items_queue, results_queue, stop_event, headless, proxy_server, set_trace, upload_executor, skip_download_errors,
+                    fetch_mode):
+    # each worker has its own browser, download directory and login
+    # if upload_executor is set, the CVs are uploaded to GCS in the background while the worker continues to the next item
+    # puts tuples of (kind, position_id, candidate_id, error) to the results queue:
+    #   kind is "uploading" when a background upload was started, the upload result is put with kind "uploaded"
+    #   kind is "downloaded" for the download result, error is None if the CV was downloaded (if uploading, error is always None)
+    # puts None when the worker is done
+    def worker_log(msg):
+        log(f'[worker {worker_num}] {msg}')
+
+    def on_upload_done(position_id, candidate_id, future):
+        results_queue.put(('uploaded', position_id, candidate_id, future.exception()))
+
+    try:
+        with tempfile.TemporaryDirectory() as download_path:
+            with driver_contextmanager(download_path, headless, proxy_server, set_trace, fetch_mode=fetch_mode) as driver:
+                is_loggedin = False
+                session_cookies = None
+                while not stop_event.is_set():
+                    try:
+                        position_id, candidate_id = items_queue.get_nowait()
+                    except queue.Empty:
+                        break
                     try:
-                        download(log, driver, download_path, position_id, candidate_id, save_to_gcs)
-                    except:
+                        url = config.CANDIDATE_POSITION_CV_URL_TEMPLATE.format(position_id=position_id, candidate_id=candidate_id)
+                        worker_log(f"Downloading CV from URL {url}")
+                        timings = Timings()
+                        if fetch_mode == 'cdp' and not is_loggedin:
+                            session_cookies = login_session(worker_log, driver)
+                            is_loggedin = True
+                            timings.record('login')
+                        driver.get(url)
+                        timings.record('navigation')
+                        if not is_loggedin:
+                            login(worker_log, driver)
+                            is_loggedin = True
+                            timings.record('login')
+                        download(worker_log, driver, download_path, position_id, candidate_id, fetch_mode=fetch_mode, timings=timings)
+                        worker_log(f'CV timings position_id: {position_id} candidate_id: {candidate_id}: {timings}')
+                        if upload_executor:
+                            results_queue.put(('uploading', position_id, candidate_id, None))
+                            upload_executor.submit(upload_cv, worker_log, position_id, candidate_id).add_done_callback(
+                                functools.partial(on_upload_done, position_id, candidate_id)
+                            )
+                        else:
+                            results_queue.put(('downloaded', position_id, candidate_id, None))
+                    except Exception as e:
+                        # same as the single CV download which dumps the browser state on error (see _driver_contextmanager)
+                        try:
+                            debug_dump(driver, basename=f'exception_{position_id}_{candidate_id}')
+                        except Exception:
+                            worker_log(f'Failed to save the browser debug dump\n{traceback.format_exc()}')
+                        # a failed download may leave files which will break the next download
+                        clear_download_path(download_path)
+                        if fetch_mode == 'cdp' and is_login_page(driver):
+                            # the session was rejected, the next item will login again
+                            from . import skeelz_session
+                            skeelz_session.invalidate(session_cookies)
+                            is_loggedin = False
                         if skip_download_errors:
-                            log(f"{traceback.format_exc()}\nError downloading position_id: {position_id} candidate_id: {candidate_id}")
+                            worker_log(f"{traceback.format_exc()}\nError downloading position_id: {position_id} candidate_id: {candidate_id}")
+                            results_queue.put(('downloaded', position_id, candidate_id, e))
                         else:
-                            raise
+                            stop_event.set()
+                            results_queue.put(('downloaded', position_id, candidate_id, e))
+                            break
+    except Exception as e:
+        stop_event.set()
+        results_queue.put(('downloaded', None, None, e))
+    finally:
+        results_queue.put(None)
+
+
+def iterate_multi(log, position_candidate_ids, headless=False, proxy_server=None, set_trace=False, save_to_gcs=False, force=False,
+                  skip_download_errors=False, jobs=None, fetch_mode=None):
+    # downloads the CVs using a pool of browser workers which take the items from a shared queue
+    # yields tuples of (position_id, candidate_id, status) as the items are processed, status is one of: exists, downloaded, failed
+    # failed items are yielded only if skip_download_errors is set, otherwise the first error is raised
+    position_candidate_ids = list(position_candidate_ids)
+    # existing CVs are checked using a single listing of the GCS cv/ prefix
+    existing_blob_names = set() if force else gcs.get_existing_blob_names([f'cv/{position_id}_{candidate_id}.pdf' for position_id, candidate_id in position_candidate_ids])
+    items_queue = queue.Queue()
+    for position_id, candidate_id in position_candidate_ids:
+        if f'cv/{position_id}_{candidate_id}.pdf' in existing_blob_names:
+            log(f'CV already exists in GCS: cv/{position_id}_{candidate_id}.pdf')
+            yield position_id, candidate_id, 'exists'
+        else:
+            items_queue.put((position_id, candidate_id))
+    jobs = min(jobs or config.DOWNLOAD_POSITION_CANDIDATE_CV_JOBS, items_queue.qsize())
+    fetch_mode = fetch_mode or config.DOWNLOAD_POSITION_CANDIDATE_CV_FETCH_MODE
+    if fetch_mode == 'cdp':
+        headless = True
+    if jobs < 1:
+        return
+    log(f'Downloading {items_queue.qsize()} CVs using {jobs} browser workers')
+    results_queue = queue.Queue()
+    stop_event = threading.Event()
+    upload_executor = gcs.get_transfer_executor() if save_to_gcs else None
+    threads = [
+        threading.Thread(target=download_worker, args=(
+            log, worker_num, items_queue, results_queue, stop_event, headless, proxy_server, set_trace, upload_executor, skip_download_errors, fetch_mode
+        ), daemon=True)
+        for worker_num in range(1, jobs + 1)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        num_running_workers = len(threads)
+        num_running_uploads = 0
+        while num_running_workers > 0 or num_running_uploads > 0:
+            result = results_queue.get()
+            if result is None:
+                num_running_workers -= 1
+            elif result[0] == 'uploading':
+                num_running_uploads += 1
+            else:
+                kind, position_id, candidate_id, error = result
+                if kind == 'uploaded':
+                    num_running_uploads -= 1
+                if error is None:
+                    yield position_id, candidate_id, 'downloaded'
+                elif skip_download_errors and position_id is not None:
+                    if kind == 'uploaded':
+                        log(f'Error uploading CV position_id: {position_id} candidate_id: {candidate_id}: {error!r}')
+                    yield position_id, candidate_id, 'failed'
+                else:
+                    raise Exception(f'Failed to {"upload" if kind == "uploaded" else "download"} CV for position_id: {position_id} candidate_id: {candidate_id}') from error
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+        if upload_executor:
+            upload_executor.shutdown(cancel_futures=True)
+
+
+def main_multi(log, position_candidate_ids, headless=False, proxy_server=None, set_trace=False, save_to_gcs=False, force=False, skip_download_errors=False,
+               jobs=None, fetch_mode=None):
+    stats = collections.Counter(
+        status for _, _, status in iterate_multi(log, position_candidate_ids, headless=headless, proxy_server=proxy_server, set_trace=set_trace,
+                                                 save_to_gcs=save_to_gcs, force=force, skip_download_errors=skip_download_errors, jobs=jobs,
+                                                 fetch_mode=fetch_mode)
+    )
+    log(f'CVs: {stats["downloaded"]} downloaded, {stats["exists"]} already exist, {stats["failed"]} failed')
 
 
-def main(log, position_id, candidate_id, headless=False, proxy_server=None, set_trace=False, save_to_gcs=False, force=False, slow_network=False):
+def main(log, position_id, candidate_id, headless=False, proxy_server=None, set_trace=False, save_to_gcs=False, force=False, slow_network=False,
+         fetch_mode=None):
+    fetch_mode = fetch_mode or config.DOWNLOAD_POSITION_CANDIDATE_CV_FETCH_MODE
+    if fetch_mode == 'cdp':
+        headless = True
     if not force and check_gcs_blob_exists(f'cv/{position_id}_{candidate_id}.pdf'):
         log(f'CV already exists in GCS: cv/{position_id}_{candidate_id}.pdf')
     else:
         with tempfile.TemporaryDirectory() as download_path:
             log(f"downloading position_id: {position_id} candidate_id: {candidate_id}")
-            with driver_contextmanager(download_path, headless, proxy_server, set_trace, slow_network=slow_network) as driver:
+            with driver_contextmanager(download_path, headless, proxy_server, set_trace, slow_network=slow_network, fetch_mode=fetch_mode) as driver:
                 url = config.CANDIDATE_POSITION_CV_URL_TEMPLATE.format(position_id=position_id, candidate_id=candidate_id)
                 log(f"Downloading CV from URL {url}")
-                driver.get(url)
-                login(log, driver)
-                download(log, driver, download_path, position_id, candidate_id, save_to_gcs)
+                timings = Timings()
+                if fetch_mode == 'cdp':
+                    login_session(log, driver)
+                    timings.record('login')
+                    driver.get(url)
+                    timings.record('navigation')
+                else:
+                    driver.get(url)
+                    timings.record('navigation')
+                    login(log, driver)
+                    timings.record('login')
+                download(log, driver, download_path, position_id, candidate_id, save_to_gcs, fetch_mode=fetch_mode, timings=timings)
+                log(f'CV timings position_id: {position_id} candidate_id: {candidate_id}: {timings}')
@@ -1,9 +1,14 @@
 import os
+import sys
 import csv
-import time
+import uuid
+import datetime
 import tempfile
+import threading
 import traceback
 import contextlib
+from textwrap import dedent
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib3.exceptions import HTTPError
 
 import backoff
@@ -12,7 +17,22 @@ import requests
 from requests.exceptions import RequestException
 from google.oauth2.service_account import Credentials as ServiceAccountCredentials
 
-from . import config, download_position_candidate_cv
+from .db import get_db_engine
+from . import config, common, download_position_candidate_cv, tables_registry, skeelz_session
+
+
+EXTRACT_TABLE_TYPES = ['google_sheet', 'smoove_blocklist', 'skeelz_export']
+
+# tables may be extracted concurrently (load_data.ensure_updated_tables), they share the google sheets cache
+extract_google_sheets_cache_lock = threading.Lock()
+
+# the Sheets API read requests quota is per project, so all the concurrent extractions in the process share the rate limiter
+google_sheets_rate_limiter = common.TokenBucket(
+    config.GOOGLE_SHEETS_READ_REQUESTS_PER_MINUTE / 60, capacity=config.GOOGLE_SHEETS_EXTRACT_CONCURRENCY
+)
+
+skeelz_http_session_lock = threading.Lock()
+skeelz_http_session = None
 
 
 @backoff.on_exception(backoff.expo, gspread.exceptions.APIError, max_time=60*30)
@@ -21,78 +41,314 @@ def list_spreadsheets(gc):
 
 
 @backoff.on_exception(backoff.expo, gspread.exceptions.APIError, max_time=60*30)
-def get_all_sheet_values(gc, spreadsheet, sheet_name=None):
-    if sheet_name:
-        sheet = gc.open(spreadsheet['name']).worksheet(sheet_name)
+def get_spreadsheet_tabs_values(gc, rate_limiter, spreadsheet_id, tab_names):
+    # gets the values of multiple tabs of the same spreadsheet using a single batch request
+    # tab_names is a list of tab names, None for the first tab
+    # returns a dict of tab name: values, values are the same as returned from gspread worksheet.get_all_values
+    if None in tab_names:
+        rate_limiter.acquire()
+        metadata = gc.request(
+            'get', gspread.urls.SPREADSHEET_URL % spreadsheet_id, params={'fields': 'sheets.properties.title'}
+        ).json()
+        first_tab_name = metadata['sheets'][0]['properties']['title']
     else:
-        sheet = gc.open(spreadsheet['name']).sheet1
-    return sheet.get_all_values()
+        first_tab_name = None
+    rate_limiter.acquire()
+    res = gc.request(
+        'get', gspread.urls.SPREADSHEET_VALUES_BATCH_URL % spreadsheet_id,
+        params={'ranges': [gspread.utils.absolute_range_name(tab_name or first_tab_name) for tab_name in tab_names]}
+    ).json()
+    tabs_values = {}
+    for tab_name, value_range in zip(tab_names, res['valueRanges']):
+        values = value_range.get('values', [])
+        tabs_values[tab_name] = gspread.utils.fill_gaps(values) if values else []
+    return tabs_values
 
 
-def extract_google_sheets(log, only_table_name=None, cache=None):
-    if cache is not None and cache.get('extract_data_google_sheets'):
-        matching_tables, gc, extract_data_tables = cache['extract_data_google_sheets']
-    else:
-        log(f'Authorizing Google Sheets service account using delegation to {config.EXTRACT_DATA_USERNAME}...')
-        gc = gspread.authorize(
-            ServiceAccountCredentials.from_service_account_file(
-                config.SERVICE_ACCOUNT_FILE, scopes=gspread.auth.READONLY_SCOPES
-            ).with_subject(config.EXTRACT_DATA_USERNAME)
+@backoff.on_exception(backoff.expo, gspread.exceptions.APIError, max_time=60*30)
+def get_spreadsheet_tab_properties(gc, rate_limiter, spreadsheet_id, tab_name):
+    # returns a tuple of (tab title, number of rows in the tab grid), tab_name None for the first tab
+    rate_limiter.acquire()
+    metadata = gc.request(
+        'get', gspread.urls.SPREADSHEET_URL % spreadsheet_id, params={'fields': 'sheets.properties(title,gridProperties.rowCount)'}
+    ).json()
+    for sheet in metadata['sheets']:
+        if tab_name is None or sheet['properties']['title'] == tab_name:
+            return sheet['properties']['title'], sheet['properties']['gridProperties']['rowCount']
+    raise gspread.exceptions.WorksheetNotFound(tab_name)
+
+
+@backoff.on_exception(backoff.expo, gspread.exceptions.APIError, max_time=60*30)
+def get_spreadsheet_range_values(gc, rate_limiter, spreadsheet_id, range_name):
+    rate_limiter.acquire()
+    res = gc.request('get', gspread.urls.SPREADSHEET_VALUES_BATCH_URL % spreadsheet_id, params={'ranges': [range_name]}).json()
+    return res['valueRanges'][0].get('values', [])
+
+
+def iterate_spreadsheet_tab_paged_values(gc, rate_limiter, spreadsheet_id, tab_name):
+    # yields the tab rows, reading GOOGLE_SHEETS_STREAM_PAGE_ROWS rows per request so that the whole tab is not kept in memory
+    # rows are the same as get_spreadsheet_tabs_values, except that they are padded to the width of the first row instead of the widest row
+    title, num_rows = get_spreadsheet_tab_properties(gc, rate_limiter, spreadsheet_id, tab_name)
+    width = None
+    # empty rows are yielded only when followed by a non-empty row, the API omits the trailing empty rows
+    num_empty_rows = 0
+    for start_row in range(1, num_rows + 1, config.GOOGLE_SHEETS_STREAM_PAGE_ROWS):
+        end_row = min(start_row + config.GOOGLE_SHEETS_STREAM_PAGE_ROWS - 1, num_rows)
+        values = get_spreadsheet_range_values(gc, rate_limiter, spreadsheet_id, gspread.utils.absolute_range_name(title, f'{start_row}:{end_row}'))
+        for row in values:
+            if not row:
+                num_empty_rows += 1
+                continue
+            if width is None:
+                width = len(row)
+            for _ in range(num_empty_rows):
+                yield [''] * width
+            num_empty_rows = 0
+            yield row + [''] * (width - len(row))
+        num_empty_rows += end_row - start_row + 1 - len(values)
+
+
+def iterate_csv_rows(file_path):
+    csv.field_size_limit(sys.maxsize)
+    with open(file_path, newline='', encoding='utf-8-sig') as file:
+        yield from csv.reader(file)
+
+
+def write_csv(table_name, rows):
+    # the csv is replaced only after all rows were written, so a failed extract does not leave a partial csv
+    target_filename = os.path.join(config.EXTRACT_DATA_PATH, f'{table_name}.csv')
+    with open(f'{target_filename}.tmp', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerows(rows)
+    os.replace(f'{target_filename}.tmp', target_filename)
+
+
+def iterate_rows_csv_snapshot(table_name, rows):
+    # writes the rows to the table csv while they are iterated
+    # the csv is written to a temp file which is renamed only after all rows were iterated, so a partial csv is never left
+    target_filename = os.path.join(config.EXTRACT_DATA_PATH, f'{table_name}.csv')
+    with open(f'{target_filename}.tmp', 'w', newline='') as file:
+        writer = csv.writer(file)
+        for row in rows:
+            writer.writerow(row)
+            yield row
+    os.replace(f'{target_filename}.tmp', target_filename)
+
+
+def get_google_sheet_source_version(table_name, spreadsheet):
+    # the source version changes when the spreadsheet is modified or when the table config / schema changes
+    from . import load_data
+    config_hash = tables_registry.get_content_hash(load_data.get_table_content_hash_config(table_name)).hexdigest()
+    return f'{spreadsheet["modifiedTime"]}_{config_hash}'
+
+
+def iterate_google_sheets_data(log, only_table_name=None, cache=None, force=False, source_versions=None, paged=False):
+    # yields tuples of (table_name, rows)
+    # if paged is set, the tables are read sequentially and rows is an iterator which reads the tab page by page
+    # otherwise the tables are read concurrently and rows is a list of all the tab rows
+    # if source_versions dict is provided, it's filled with the source versions (spreadsheet modifiedTime and table config hash) of all the matching tables
+    # and tables whose spreadsheet and config were not modified since the last successful load of the table are skipped, unless force is set
+    # the source versions should be stored in the tables registry after the tables are loaded
+    with extract_google_sheets_cache_lock:
+        if cache is not None and cache.get('extract_data_google_sheets'):
+            matching_tables, gc, extract_data_tables = cache['extract_data_google_sheets']
+        else:
+            log(f'Authorizing Google Sheets service account using delegation to {config.EXTRACT_DATA_USERNAME}...')
+            gc = gspread.authorize(
+                ServiceAccountCredentials.from_service_account_file(
+                    config.SERVICE_ACCOUNT_FILE, scopes=gspread.auth.READONLY_SCOPES
+                ).with_subject(config.EXTRACT_DATA_USERNAME)
+            )
+            log('Fetching matching sheets...')
+            matching_tables = {}
+            spreadsheets = list_spreadsheets(gc)
+            spreadsheets.sort(key=lambda x: x['createdTime'], reverse=True)
+            extract_data_tables = {n: t for n, t in config.EXTRACT_DATA_TABLES.items() if t['type'] == "google_sheet"}
+            for spreadsheet in spreadsheets:
+                name = spreadsheet['name']
+                for key, value in extract_data_tables.items():
+                    if value['google_sheet_name'].strip() == name.strip():
+                        matching_tables[key] = spreadsheet
+            log(f'Found {len(matching_tables)} matching sheets')
+            if cache is not None:
+                cache['extract_data_google_sheets'] = matching_tables, gc, extract_data_tables
+    # spreadsheets are opened by id and all tabs of a spreadsheet are fetched in a single batch request
+    # spreadsheets are fetched in parallel, limited by the Sheets API read requests quota
+    table_names = [n for n in matching_tables if only_table_name is None or only_table_name == n]
+    loaded_source_versions = {} if force or source_versions is None else tables_registry.get_source_versions(table_names)
+    spreadsheets_tables = {}
+    for table_name in table_names:
+        spreadsheet = matching_tables[table_name]
+        source_version = get_google_sheet_source_version(table_name, spreadsheet)
+        if source_versions is not None:
+            source_versions[table_name] = source_version
+        if loaded_source_versions.get(table_name) == source_version:
+            log(f'Skipping {table_name}, spreadsheet and table config were not modified since last load ({spreadsheet["modifiedTime"]})')
+        else:
+            spreadsheets_tables.setdefault(spreadsheet['id'], {})[table_name] = extract_data_tables[table_name].get('tab_name')
+    if not spreadsheets_tables:
+        return
+    if paged:
+        for spreadsheet_id, tables in spreadsheets_tables.items():
+            for table_name, tab_name in tables.items():
+                yield table_name, iterate_spreadsheet_tab_paged_values(gc, google_sheets_rate_limiter, spreadsheet_id, tab_name)
+        return
+    with ThreadPoolExecutor(max_workers=config.GOOGLE_SHEETS_EXTRACT_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(get_spreadsheet_tabs_values, gc, google_sheets_rate_limiter, spreadsheet_id, list(set(tables.values()))): tables
+            for spreadsheet_id, tables in spreadsheets_tables.items()
+        }
+        for future in as_completed(futures):
+            tabs_values = future.result()
+            for table_name, tab_name in futures[future].items():
+                yield table_name, tabs_values[tab_name]
+
+
+def extract_google_sheets(log, only_table_name=None, cache=None, force=False, source_versions=None):
+    for table_name, data in iterate_google_sheets_data(log, only_table_name=only_table_name, cache=cache, force=force, source_versions=source_versions):
+        write_csv(table_name, data)
+        yield table_name
+
+
+def get_smoove_http_session():
+    session = common.requests_session_retry(status_forcelist=(429, 500, 502, 503, 504))
+    session.headers['Authorization'] = f'Bearer {config.SMOOVE_API_KEY}'
+    return session
+
+
+def iterate_smoove_blocklist_pages(log, session, min_id=None):
+    # yields the blocklisted contacts page by page, sorted by descending id
+    # if min_id is set, stops after reaching a contact with id <= min_id
+    page_size = config.SMOOVE_API_PAGE_SIZE
+    skip = 0
+    last_page_ids = None
+    while True:
+        res = session.get(
+            'https://rest.smoove.io/v1/Contacts_Blacklisted',
+            params={'fields': 'id,email', 'sort': '-id', 'skip': skip, 'take': page_size},
         )
-        log('Fetching matching sheets...')
-        matching_tables = {}
-        spreadsheets = list_spreadsheets(gc)
-        spreadsheets.sort(key=lambda x: x['createdTime'], reverse=True)
-        extract_data_tables = {n: t for n, t in config.EXTRACT_DATA_TABLES.items() if t['type'] == "google_sheet"}
-        for spreadsheet in spreadsheets:
-            name = spreadsheet['name']
-            for key, value in extract_data_tables.items():
-                if value['google_sheet_name'].strip() == name.strip():
-                    matching_tables[key] = spreadsheet
-        log(f'Found {len(matching_tables)} matching sheets')
-        if cache is not None:
-            cache['extract_data_google_sheets'] = matching_tables, gc, extract_data_tables
-    for table_name, spreadsheet in matching_tables.items():
-        if only_table_name is None or only_table_name == table_name:
-            data = get_all_sheet_values(gc, spreadsheet, extract_data_tables[table_name].get('tab_name'))
-            with open(os.path.join(config.EXTRACT_DATA_PATH, f'{table_name}.csv'), 'w', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerows(data)
-            yield table_name
-
-
-def extract_smoove_blocklist(log):
+        assert res.status_code == 200, f'unexpected status_code: {res.status_code} - {res.text}'
+        page = res.json()
+        page_ids = [contact['id'] for contact in page]
+        assert not page_ids or page_ids != last_page_ids, f'got the same page twice (skip={skip}), paging is not supported by the API'
+        last_page_ids = page_ids
+        if min_id is not None:
+            new_contacts = [contact for contact in page if int(contact['id']) > min_id]
+            if new_contacts:
+                yield new_contacts
+            if len(new_contacts) < len(page):
+                break
+        elif page:
+            yield page
+        if len(page) < page_size:
+            break
+        skip += len(page)
+        log(f'Extracted {skip} smoove_blocklist contacts...')
+
+
+def get_smoove_blocklist_stored_rows():
+    # returns the rows of the loaded smoove_blocklist DB table as [email, id] lists, or None if it was not loaded with the id column
+    # the DB table is used and not the extracted csv, because the csv is not kept between runs (and is not written with --skip-csv-snapshot)
+    with get_db_engine().connect() as conn:
+        with conn.begin():
+            if not conn.execute(dedent('''
+                select 1 from information_schema.columns
+                where table_schema = current_schema() and table_name = 'smoove_blocklist' and column_name in ('email', 'id')
+                having count(*) = 2
+            ''')).first():
+                return None
+            return [[row.email, row.id or ''] for row in conn.execute('select email, id from smoove_blocklist') if row.email]
+
+
+def get_smoove_blocklist_incremental_stored_rows(log, force=False, source_versions=None):
+    # returns the stored rows to merge with an incremental extract, or None if a full extract should be done
+    # the id is assigned when the contact is created, so existing contacts which were blacklisted since the last extract, and removals
+    # from the blocklist, are detected only by a full extract - which is done every full_extract_hours (default 24) of the table config, or with force
+    # the source version of the table is the time of the last full extract, it's stored in the tables registry only after the table is loaded
+    # so if source_versions dict is provided, it's filled with the time of this full extract, or the time of the previous one for an incremental extract
+    table_config = config.EXTRACT_DATA_TABLES.get('smoove_blocklist', {})
+    now = datetime.datetime.now(datetime.timezone.utc)
+    last_full_extract = stored_rows = None
+    if not force and table_config.get('incremental'):
+        last_full_extract = tables_registry.get_source_versions(['smoove_blocklist']).get('smoove_blocklist')
+        full_extract_hours = table_config.get('full_extract_hours', 24)
+        if not last_full_extract:
+            log('No full smoove_blocklist extract was loaded, doing a full extract')
+        elif now - datetime.datetime.fromisoformat(last_full_extract) >= datetime.timedelta(hours=full_extract_hours):
+            log(f'Last full smoove_blocklist extract was at {last_full_extract}, more than {full_extract_hours} hours ago, doing a full extract')
+        else:
+            stored_rows = get_smoove_blocklist_stored_rows()
+    if source_versions is not None:
+        source_versions['smoove_blocklist'] = last_full_extract if stored_rows else now.isoformat()
+    return stored_rows
+
+
+def iterate_smoove_blocklist_rows(log, stored_rows=None):
+    # emails are normalized (lowercase, trimmed) and deduplicated
+    # if stored_rows are provided, only contacts with id greater than the max stored id are fetched and merged with the stored rows
     log('Extracting smoove_blocklist...')
-    res = requests.get(
-        'https://rest.smoove.io/v1/Contacts_Blacklisted?fields=email',
-        headers={'Authorization': f'Bearer {config.SMOOVE_API_KEY}'}
-    )
-    assert res.status_code == 200, f'unexpected status_code: {res.status_code} - {res.text}'
-    with open(os.path.join(config.EXTRACT_DATA_PATH, f'smoove_blocklist.csv'), 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['email'])
-        for contact in res.json():
-            writer.writerow([contact['email']])
+    min_id = max((int(row[1]) for row in stored_rows if row[1]), default=None) if stored_rows else None
+    if min_id is not None:
+        log(f'Extracting smoove_blocklist contacts added since id {min_id}')
+    yield ['email', 'id']
+    emails = set()
+    num_new_rows = 0
+    with get_smoove_http_session() as session:
+        for page in iterate_smoove_blocklist_pages(log, session, min_id=min_id):
+            for contact in page:
+                email = (contact.get('email') or '').strip().lower()
+                if email and email not in emails:
+                    emails.add(email)
+                    num_new_rows += 1
+                    yield [email, str(contact['id'])]
+    for email, id_ in (stored_rows or []):
+        if email not in emails:
+            emails.add(email)
+            yield [email, id_]
+    log(f'Extracted smoove_blocklist: {num_new_rows} new contacts, {len(emails)} total contacts')
+
+
+def extract_smoove_blocklist(log, force=False, source_versions=None):
+    stored_rows = get_smoove_blocklist_incremental_stored_rows(log, force=force, source_versions=source_versions)
+    write_csv('smoove_blocklist', iterate_smoove_blocklist_rows(log, stored_rows))
     yield 'smoove_blocklist'
 
 
-def download_post_streaming(url, target_filename, **kwargs):
-    with requests.post(url, stream=True, **kwargs) as res:
-        res.raise_for_status()
-        with open(target_filename, 'wb') as file:
-            for chunk in res.iter_content(chunk_size=8192):
-                file.write(chunk)
+def get_skeelz_http_session():
+    # a single pooled session is shared by all the concurrent skeelz export downloads
+    global skeelz_http_session
+    with skeelz_http_session_lock:
+        if skeelz_http_session is None:
+            skeelz_http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config.SKEELZ_EXPORT_DOWNLOAD_CONCURRENCY)
+            skeelz_http_session.mount('https://', adapter)
+            skeelz_http_session.mount('http://', adapter)
+        return skeelz_http_session
 
 
-def check_cookies(cookies):
-    cookie_names = [c['name'] for c in cookies if c['domain'] == 'skeelz.retrain.ai']
-    return 'id_token' in cookie_names and 'access_token' in cookie_names and '__rtr_sofi' in cookie_names and '__rtr_state' in cookie_names
+def download_post_streaming(url, target_filename, session=None, chunk_size=8192, **kwargs):
+    # the file is downloaded to a temporary file in the same directory and renamed only after a successful download
+    # so that a partial file will never be loaded
+    # the temporary file is created with open, so it gets the same default permissions as the other extracted files
+    temp_filename = os.path.join(os.path.dirname(target_filename), f'.{os.path.basename(target_filename)}.{uuid.uuid4().hex}.tmp')
+    with (session or requests).post(url, stream=True, **kwargs) as res:
+        res.raise_for_status()
+        with open(temp_filename, 'xb') as file:
+            try:
+                for chunk in res.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+            except:
+                file.close()
+                os.unlink(temp_filename)
+                raise
+    os.replace(temp_filename, target_filename)
 
 
 @contextlib.contextmanager
 def get_extract_skeelz_exports_context(cache, needs_skeelz_export=True):
-    if needs_skeelz_export:
-        if 'extract_skeelz_exports_context' in cache:
+    # the browser is needed only to login, so it's not started if there is a valid Skeelz session
+    if needs_skeelz_export and not skeelz_session.get_valid_cookies():
+        if cache.get('extract_skeelz_exports_context'):
             yield cache['extract_skeelz_exports_context']
         else:
             headless = False
@@ -101,62 +357,122 @@ def get_extract_skeelz_exports_context(cache, needs_skeelz_export=True):
             with tempfile.TemporaryDirectory() as download_path:
                 with download_position_candidate_cv.driver_contextmanager(download_path, headless, proxy_server, set_trace) as driver:
                     cache['extract_skeelz_exports_context'] = download_path, driver
-                    yield cache['extract_skeelz_exports_context']
+                    try:
+                        yield cache['extract_skeelz_exports_context']
+                    finally:
+                        cache['extract_skeelz_exports_context'] = None
     else:
         cache['extract_skeelz_exports_context'] = None
         yield cache['extract_skeelz_exports_context']
 
 
-def get_skeelz_export_cookies(log):
-    with get_extract_skeelz_exports_context({}, needs_skeelz_export=True) as (download_path, driver):
-        driver.get(config.CANDIDATE_POSITION_CV_URL_TEMPLATE.format(position_id='', candidate_id=''))
-        download_position_candidate_cv.login(log, driver)
-        for i in range(20):
-            time.sleep(1)
-            if check_cookies(driver.get_cookies()):
-                break
-        cookies = driver.get_cookies()
-    assert check_cookies(cookies)
-    return cookies
+def get_skeelz_export_cookies(log, cache=None):
+    # uses the browser from the cache context for login, if available
+    context = (cache or {}).get('extract_skeelz_exports_context')
+    return skeelz_session.get_cookies(log, driver=context[1] if context else None)
 
 
 @backoff.on_exception(backoff.constant, (RequestException, HTTPError), max_tries=5, interval=2)
-def extract_skeelz_export_download(log, url, target_filename):
-    cookies = get_skeelz_export_cookies(log)
-    download_post_streaming(url, target_filename, cookies={c['name']: c['value'] for c in cookies})
+def extract_skeelz_export_download(log, url, target_filename, cache=None):
+    cookies = get_skeelz_export_cookies(log, cache)
+    try:
+        download_post_streaming(url, target_filename, session=get_skeelz_http_session(), chunk_size=config.SKEELZ_EXPORT_DOWNLOAD_CHUNK_SIZE,
+                                cookies={c['name']: c['value'] for c in cookies})
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code in (401, 403):
+            # the session was rejected, the retry will login again
+            skeelz_session.invalidate(cookies)
+        raise
+
+
+def extract_skeelz_export(log, table_name, table_config, cache=None):
+    # returns True if the table was downloaded, False if it failed and on_failure is set to "skip"
+    target_filename = os.path.join(config.EXTRACT_DATA_PATH, f'{table_name}.csv')
+    log(f'Downloading {table_name} to {target_filename}')
+    try:
+        extract_skeelz_export_download(log, table_config['url'], target_filename, cache)
+        return True
+    except:
+        if table_config.get('on_failure') == 'skip':
+            log(f'Failed to download {table_name}, but on_failure is set to "skip", so skipping...\n{traceback.format_exc()}')
+            return False
+        else:
+            raise
 
 
 def extract_skeelz_exports(log, only_table_name=None, cache=None):
+    # exports are downloaded concurrently, table names are yielded as their download completes
     log('Extracting skeelz_exports...')
-    for table_name, table_config in config.EXTRACT_DATA_TABLES.items():
-        if table_config['type'] != 'skeelz_export':
-            continue
-        if only_table_name and only_table_name != table_name:
-            continue
-        target_filename = os.path.join(config.EXTRACT_DATA_PATH, f'{table_name}.csv')
-        log(f'Downloading {table_name} to {target_filename}')
+    tables = {
+        table_name: table_config
+        for table_name, table_config in config.EXTRACT_DATA_TABLES.items()
+        if table_config['type'] == 'skeelz_export' and (not only_table_name or only_table_name == table_name)
+    }
+    if not tables:
+        return
+    # login (if needed) before starting the downloads
+    try:
+        get_skeelz_export_cookies(log, cache)
+    except:
+        if all(table_config.get('on_failure') == 'skip' for table_config in tables.values()):
+            log(f'Failed to login to Skeelz, but on_failure is set to "skip" for all the exports, so skipping...\n{traceback.format_exc()}')
+            return
+        else:
+            raise
+    with ThreadPoolExecutor(max_workers=config.SKEELZ_EXPORT_DOWNLOAD_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(extract_skeelz_export, log, table_name, table_config, cache): table_name
+            for table_name, table_config in tables.items()
+        }
         try:
-            extract_skeelz_export_download(log, table_config['url'], target_filename)
-            yield table_name
-        except:
-            if table_config.get('on_failure') == 'skip':
-                log(f'Failed to download {table_name}, but on_failure is set to "skip", so skipping...\n{traceback.format_exc()}')
-            else:
-                raise
+            for future in as_completed(futures):
+                if future.result():
+                    yield futures[future]
+        finally:
+            for future in futures:
+                future.cancel()
 
 
-def main(log, only_table_name=None, cache=None, only_table_types=None):
-    os.makedirs(config.EXTRACT_DATA_PATH, exist_ok=True)
+def iterate_table_types(only_table_name=None, only_table_types=None):
     if only_table_types and isinstance(only_table_types, str):
         only_table_types = [t.strip() for t in only_table_types.split(',') if t.strip()]
-    if not only_table_types or 'google_sheet' in only_table_types:
-        if not only_table_name or only_table_name in [n for n, t in config.EXTRACT_DATA_TABLES.items() if t['type'] == 'google_sheet']:
-            yield from extract_google_sheets(log, only_table_name=only_table_name, cache=cache)
     smoove_blocklist_table_names = [n for n, t in config.EXTRACT_DATA_TABLES.items() if t['type'] == 'smoove_blocklist']
     assert len(smoove_blocklist_table_names) <= 1, f'Only one smoove_blocklist table is allowed'
-    if not only_table_types or 'smoove_blocklist' in only_table_types:
-        if not only_table_name or only_table_name in smoove_blocklist_table_names:
-            yield from extract_smoove_blocklist(log)
-    if not only_table_types or 'skeelz_export' in only_table_types:
-        if not only_table_name or only_table_name in [n for n, t in config.EXTRACT_DATA_TABLES.items() if t['type'] == 'skeelz_export']:
+    for table_type in EXTRACT_TABLE_TYPES:
+        if not only_table_types or table_type in only_table_types:
+            if not only_table_name or only_table_name in [n for n, t in config.EXTRACT_DATA_TABLES.items() if t['type'] == table_type]:
+                yield table_type
+
+
+def main(log, only_table_name=None, cache=None, only_table_types=None, force=False, source_versions=None):
+    # source_versions - optional dict which is filled with the source version of tables which support incremental extraction,
+    #                   if provided, tables which were not modified since their source version was last loaded are not extracted, unless force is set
+    os.makedirs(config.EXTRACT_DATA_PATH, exist_ok=True)
+    for table_type in iterate_table_types(only_table_name=only_table_name, only_table_types=only_table_types):
+        if table_type == 'google_sheet':
+            yield from extract_google_sheets(log, only_table_name=only_table_name, cache=cache, force=force, source_versions=source_versions)
+        elif table_type == 'smoove_blocklist':
+            yield from extract_smoove_blocklist(log, force=force, source_versions=source_versions)
+        elif table_type == 'skeelz_export':
             yield from extract_skeelz_exports(log, only_table_name=only_table_name, cache=cache)
+
+
+def stream(log, only_table_name=None, cache=None, only_table_types=None, csv_snapshot=True, force=False, source_versions=None):
+    # yields tuples of (table_name, rows) where rows is an iterator of the table rows, starting with the headers row
+    # rows should be fully consumed before continuing to the next table
+    # google sheets and smoove blocklist rows are streamed directly from the API without writing a csv (unless csv_snapshot is set)
+    # google sheets are read page by page (GOOGLE_SHEETS_STREAM_PAGE_ROWS rows per request)
+    # skeelz exports are still downloaded to a csv file because the download is not retryable in the middle of a stream
+    os.makedirs(config.EXTRACT_DATA_PATH, exist_ok=True)
+    for table_type in iterate_table_types(only_table_name=only_table_name, only_table_types=only_table_types):
+        if table_type == 'google_sheet':
+            for table_name, data in iterate_google_sheets_data(log, only_table_name=only_table_name, cache=cache, force=force, source_versions=source_versions,
+                                                               paged=True):
+                yield table_name, iterate_rows_csv_snapshot(table_name, data) if csv_snapshot else data
+        elif table_type == 'smoove_blocklist':
+            stored_rows = get_smoove_blocklist_incremental_stored_rows(log, force=force, source_versions=source_versions)
+            rows = iterate_smoove_blocklist_rows(log, stored_rows)
+            yield 'smoove_blocklist', iterate_rows_csv_snapshot('smoove_blocklist', rows) if csv_snapshot else rows
+        elif table_type == 'skeelz_export':
+            for table_name in extract_skeelz_exports(log, only_table_name=only_table_name, cache=cache):
+                yield table_name, iterate_csv_rows(os.path.join(config.EXTRACT_DATA_PATH, f'{table_name}.csv'))
@@ -0,0 +1,88 @@
+import os
+import time
+import ctypes
+import select
+import struct
+import ctypes.util
+
+
+# inotify constants from sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+POLLING_INTERVAL_SECONDS = 0.1
+
+
+def get_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return libc if hasattr(libc, 'inotify_init1') else None
+    except OSError:
+        return None
+
+
+class DirectoryWatcher:
+    # waits for a file to be completely written to a directory
+    # uses inotify (close after write / moved into the directory) when available, otherwise falls back to polling
+    # should be created before the action which writes the file, to make sure the event is not missed
+
+    def __init__(self, path, suffix=''):
+        self.path = path
+        self.suffix = suffix
+        self.fd = None
+        libc = get_libc()
+        if libc:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def get_existing_filename(self):
+        filenames = [filename for filename in os.listdir(self.path) if filename.endswith(self.suffix)]
+        return filenames[0] if filenames else None
+
+    def iterate_inotify_filenames(self, timeout):
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                yield os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+
+    def wait(self, timeout):
+        # returns the name of the written file, raises TimeoutError if no file was written within the timeout
+        end_time = time.monotonic() + timeout
+        while True:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'no {self.suffix} file was written to {self.path} within {timeout} seconds')
+            if self.fd is None:
+                filename = self.get_existing_filename()
+                if filename:
+                    return filename
+                time.sleep(min(POLLING_INTERVAL_SECONDS, remaining))
+            else:
+                for filename in self.iterate_inotify_filenames(remaining):
+                    if filename.endswith(self.suffix):
+                        return filename
@@ -0,0 +1,110 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import backoff
+import requests
+import google.cloud.storage
+import google.cloud.exceptions
+import google.api_core.exceptions
+
+from . import config
+
+
+# a single storage client is shared by the whole process
+client_lock = threading.Lock()
+client = None
+
+# prefix listings are cached for the run, blob name: blob
+listings_lock = threading.Lock()
+listings = {}
+
+# transient errors which are retried by the transfer functions
+TRANSFER_RETRY_EXCEPTIONS = (
+    google.api_core.exceptions.TooManyRequests,
+    google.api_core.exceptions.InternalServerError,
+    google.api_core.exceptions.BadGateway,
+    google.api_core.exceptions.ServiceUnavailable,
+    google.api_core.exceptions.GatewayTimeout,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+def get_client():
+    global client
+    with client_lock:
+        if client is None:
+            client = google.cloud.storage.Client.from_service_account_json(config.SERVICE_ACCOUNT_FILE)
+        return client
+
+
+def get_bucket():
+    return get_client().bucket(config.GCS_BUCKET_NAME)
+
+
+def get_listing(prefix):
+    # returns a dict of blob name: blob for all the blobs under the prefix, listed once per run
+    with listings_lock:
+        if prefix not in listings:
+            listings[prefix] = {blob.name: blob for blob in get_client().list_blobs(config.GCS_BUCKET_NAME, prefix=prefix)}
+        return listings[prefix]
+
+
+def get_listing_prefix(blob_name):
+    # blobs are listed by their top level directory, e.g. cv/
+    return blob_name.split('/')[0] + '/' if '/' in blob_name else None
+
+
+def get_blob(blob_name):
+    # returns the listed blob or None if it doesn't exist
+    prefix = get_listing_prefix(blob_name)
+    if prefix is None:
+        blob = get_bucket().get_blob(blob_name)
+    else:
+        blob = get_listing(prefix).get(blob_name)
+    return blob
+
+
+def blob_exists(blob_name, use_listing=True):
+    # use_listing - check in the cached prefix listing, should be used only when checking many blobs under the same prefix
+    if use_listing:
+        return get_blob(blob_name) is not None
+    else:
+        return get_bucket().blob(blob_name).exists()
+
+
+def get_existing_blob_names(blob_names):
+    return {blob_name for blob_name in blob_names if blob_exists(blob_name)}
+
+
+@backoff.on_exception(backoff.expo, TRANSFER_RETRY_EXCEPTIONS, max_tries=5)
+def upload_file(source_file_name, destination_blob_name):
+    blob = get_bucket().blob(destination_blob_name)
+    with open(source_file_name, "rb") as f:
+        blob.upload_from_file(f)
+    prefix = get_listing_prefix(destination_blob_name)
+    with listings_lock:
+        if prefix in listings:
+            listings[prefix][destination_blob_name] = blob
+    return blob
+
+
+def download_file(source_blob_name, destination_file_name):
+    # returns False if the blob doesn't exist
+    try:
+        download_blob_to_filename(get_bucket().blob(source_blob_name), destination_file_name)
+        return True
+    except google.cloud.exceptions.NotFound:
+        return False
+
+
+@backoff.on_exception(backoff.expo, TRANSFER_RETRY_EXCEPTIONS, max_tries=5)
+def download_blob_to_filename(blob, destination_file_name):
+    blob.download_to_filename(destination_file_name)
+
+
+def get_transfer_executor(max_workers=None):
+    # thread pool for concurrent transfers, should be used as a context manager to wait for the transfers to complete
+    # the transfers share the storage client, so the concurrency is bounded by GCS_TRANSFER_CONCURRENCY
+    return ThreadPoolExecutor(max_workers=max_workers or config.GCS_TRANSFER_CONCURRENCY, thread_name_prefix='gcs_transfer')
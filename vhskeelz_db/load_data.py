@@ -1,18 +1,67 @@
 import os
 import time
+import queue
+import threading
 import random
 import traceback
 from textwrap import dedent
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 
 import dataflows as DF
 
 
-from . import config, extract_data
-from .db import get_db_engine
+from . import config, extract_data, tables_registry
+from .db import get_db_engine, recreate_text_table_copy, quote_identifier
 from .processing_record import processing_record
 
 
+# default schema of tables which are used by the mailing and salesforce queries, merged with the "schema" key of the table config
+# columns - column name: postgresql type, the text values are cast to this type
+# derived_columns - column name: {"type": postgresql type, "sql": sql expression based on the table columns}
+# indexes - list of lists of column names to create indexes on
+DEFAULT_TABLES_SCHEMAS = {
+    'skeelz_export_candidates_to_positions': {
+        'derived_columns': {
+            'fit_percentage': {
+                'type': 'float',
+                'sql': r'''case when "Candidate-Position fit rate" ~ '^\s*-?[0-9]+(\.[0-9]+)?\s*%?\s*$' then CAST(replace("Candidate-Position fit rate", '%', '') AS FLOAT) / 100 end''',
+            },
+        },
+        'indexes': [['Candidate Id'], ['Position Id']],
+    },
+    'skeelz_export_candidates': {
+        'indexes': [['Candidate id']],
+    },
+    'skeelz_export_positions': {
+        'indexes': [['Position id']],
+    },
+    'smoove_blocklist': {
+        'indexes': [['email']],
+    },
+    # the blocklists trimmed ids are compared to the mailing ids (see blocklists.get_sql_conditions)
+    'aggregation_candidate_positions': {
+        'derived_columns': {
+            'candidate_id': {'type': 'text', 'sql': 'trim("Candidate_id")'},
+            'position_id': {'type': 'text', 'sql': 'trim("Position_id")'},
+        },
+        'indexes': [['candidate_id', 'position_id']],
+    },
+    'aggregation_candidates': {
+        'derived_columns': {
+            'candidate_id': {'type': 'text', 'sql': 'trim("Candidate_id")'},
+        },
+        'indexes': [['candidate_id']],
+    },
+    'aggregation_positions': {
+        'derived_columns': {
+            'position_id': {'type': 'text', 'sql': 'trim("P_ID")'},
+        },
+        'indexes': [['position_id']],
+    },
+}
+
+
 class df_load_reduplicate_headers(DF.load):
 
     @staticmethod
@@ -37,67 +86,375 @@ def validate_data(table_name):
     return _iterator
 
 
-def load_table(table_name):
-    file_path = os.path.join(config.EXTRACT_DATA_PATH, f'{table_name}.csv')
-    assert os.path.exists(file_path), f'File not found: {file_path}'
-    temp_table_name = f'__temp__{table_name}'
+def get_reduplicated_headers_indexes(headers):
+    # same behavior as df_load_reduplicate_headers - header names are stripped, columns with an empty header are dropped
+    # and duplicate headers are loaded as a single column with the last value
+    headers_indexes = {}
+    for i, header in enumerate(headers):
+        header = (header or '').strip()
+        if header:
+            headers_indexes[header] = i
+    return headers_indexes
+
+
+def load_temp_table_copy(table_name, temp_table_name, rows):
+    rows = iter(rows)
+    headers_indexes = get_reduplicated_headers_indexes(next(rows))
+    with get_db_engine().connect() as conn:
+        with conn.begin():
+            return recreate_text_table_copy(conn, temp_table_name, list(headers_indexes), (
+                [row[i] if i < len(row) else None for i in headers_indexes.values()]
+                for row in validate_data(table_name)(rows)
+            ))
+
+
+def load_temp_table_dataflows(table_name, temp_table_name, file_path):
+    engine = get_db_engine()
     DF.Flow(
         df_load_reduplicate_headers(file_path, name=table_name, infer_strategy=DF.load.INFER_STRINGS, deduplicate_headers=True),
         validate_data(table_name),
         DF.dump_to_sql(
             {temp_table_name: {'resource-name': table_name}},
-            get_db_engine(),
+            engine,
             batch_size=100000,
         )
     ).process()
+    with engine.connect() as conn:
+        return conn.execute(f'select count(1) from {temp_table_name}').scalar()
+
+
+def get_table_schema(table_name):
+    default_schema = DEFAULT_TABLES_SCHEMAS.get(table_name, {})
+    table_schema = config.EXTRACT_DATA_TABLES[table_name].get('schema', {})
+    return {
+        'columns': {**default_schema.get('columns', {}), **table_schema.get('columns', {})},
+        'derived_columns': {**default_schema.get('derived_columns', {}), **table_schema.get('derived_columns', {})},
+        'indexes': [*default_schema.get('indexes', []), *table_schema.get('indexes', [])],
+    }
+
+
+def get_index_name(table_name, i):
+    return f'{table_name}__idx{i}'
+
+
+def apply_table_schema(table_name, temp_table_name):
+    # applies the table schema to the temp table, returns the names of the created indexes
+    # indexes are created with temp names and should be renamed after the temp table is renamed
+    schema = get_table_schema(table_name)
+    sqls = []
+    for column_name, column_type in schema['columns'].items():
+        column_name = quote_identifier(column_name)
+        sqls.append(f"alter table {temp_table_name} alter column {column_name} type {column_type} using nullif(nullif(trim({column_name}), ''), 'null')::{column_type};")
+    for column_name, derived_column in schema['derived_columns'].items():
+        sqls.append(f"alter table {temp_table_name} add column {quote_identifier(column_name)} {derived_column['type']};")
+    if schema['derived_columns']:
+        set_sqls = [f"{quote_identifier(column_name)} = {derived_column['sql']}" for column_name, derived_column in schema['derived_columns'].items()]
+        sqls.append(f"update {temp_table_name} set {', '.join(set_sqls)};")
+    index_names = []
+    for i, column_names in enumerate(schema['indexes']):
+        index_names.append(get_index_name(table_name, i))
+        sqls.append(f"create index {get_index_name(temp_table_name, i)} on {temp_table_name} ({', '.join(quote_identifier(column_name) for column_name in column_names)});")
+    sqls.append(f'analyze {temp_table_name};')
+    with get_db_engine().connect() as conn:
+        with conn.begin():
+            # using the dbapi cursor directly, so that the schema sqls don't need to escape % characters
+            cursor = conn.connection.cursor()
+            try:
+                for sql in sqls:
+                    try:
+                        cursor.execute(sql)
+                    except Exception as e:
+                        raise Exception(f'Error applying table schema:\n{sql}') from e
+            finally:
+                cursor.close()
+    return index_names
+
+
+def get_table_content_hash_config(table_name):
+    return {**config.EXTRACT_DATA_TABLES[table_name], 'schema': get_table_schema(table_name)}
+
+
+def swap_temp_table(table_name, temp_table_name, content_hash, num_rows, source_version=None):
+    index_names = apply_table_schema(table_name, temp_table_name)
     with get_db_engine().connect() as conn:
         with conn.begin():
             conn.execute(dedent(f'''
                     drop table if exists {table_name};
                     alter table {temp_table_name} rename to {table_name};
                 '''))
+            for index_name in index_names:
+                conn.execute(f'alter index __temp__{index_name} rename to {index_name};')
+            tables_registry.update_table(conn, table_name, content_hash, num_rows, source_version)
+
+
+def load_table(table_name, loader=None, force=False, source_version=None):
+    # returns False if the table was skipped because the content did not change since it was last loaded
+    loader = loader or config.LOAD_DATA_LOADER
+    file_path = os.path.join(config.EXTRACT_DATA_PATH, f'{table_name}.csv')
+    assert os.path.exists(file_path), f'File not found: {file_path}'
+    temp_table_name = f'__temp__{table_name}'
+    content_hash = tables_registry.get_file_content_hash(get_table_content_hash_config(table_name), file_path)
+    if not force:
+        with get_db_engine().connect() as conn:
+            with conn.begin():
+                if tables_registry.is_table_unchanged(conn, table_name, content_hash):
+                    if source_version:
+                        tables_registry.update_table_source_version(conn, table_name, source_version)
+                    return False
+    if loader == 'copy':
+        num_rows = load_temp_table_copy(table_name, temp_table_name, extract_data.iterate_csv_rows(file_path))
+    elif loader == 'dataflows':
+        num_rows = load_temp_table_dataflows(table_name, temp_table_name, file_path)
+    else:
+        raise Exception(f'Unknown loader: {loader}')
+    swap_temp_table(table_name, temp_table_name, content_hash, num_rows, source_version)
+    return True
+
+
+def load_table_rows(table_name, rows, force=False, source_version=None):
+    # loads the table from an iterator of rows (starting with the headers row) using COPY, without an intermediate csv
+    # the content hash is calculated while streaming, so unchanged tables are loaded to the temp table but the swap is skipped
+    # returns False if the swap was skipped
+    temp_table_name = f'__temp__{table_name}'
+    content_hash = tables_registry.get_content_hash(get_table_content_hash_config(table_name))
+    num_rows = load_temp_table_copy(table_name, temp_table_name, tables_registry.iterate_rows_update_content_hash(content_hash, rows))
+    if not force:
+        with get_db_engine().connect() as conn:
+            with conn.begin():
+                if tables_registry.is_table_unchanged(conn, table_name, content_hash.hexdigest()):
+                    conn.execute(f'drop table {temp_table_name}')
+                    if source_version:
+                        tables_registry.update_table_source_version(conn, table_name, source_version)
+                    return False
+    swap_temp_table(table_name, temp_table_name, content_hash.hexdigest(), num_rows, source_version)
+    return True
+
+
+def load_table_or_raise(table_name, loader=None, force=False, rows=None, source_versions=None):
+    source_version = source_versions.get(table_name) if source_versions else None
+    try:
+        if rows is None:
+            return table_name, load_table(table_name, loader=loader, force=force, source_version=source_version)
+        else:
+            return table_name, load_table_rows(table_name, rows, force=force, source_version=source_version)
+    except Exception as e:
+        raise Exception(f'Failed to load table {table_name}') from e
+
+
+def iterate_load_tables(table_names, loader=None, jobs=1, force=False, source_versions=None):
+    # yields tuples of (table_name, loaded) as the tables are processed, with jobs > 1 tables are loaded concurrently
+    # each load_table call creates its own db engine, so each worker uses its own db connection
+    if jobs > 1:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        futures = set()
+        try:
+            for table_name in table_names:
+                futures.add(executor.submit(load_table_or_raise, table_name, loader=loader, force=force, source_versions=source_versions))
+                done_futures, futures = wait(futures, timeout=0)
+                for future in done_futures:
+                    yield future.result()
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    else:
+        for table_name in table_names:
+            yield load_table_or_raise(table_name, loader=loader, force=force, source_versions=source_versions)
+
+
+def iterate_stream_load_tables(log, only_table_name=None, cache=None, only_table_types=None, force=False, csv_snapshot=True, source_versions=None):
+    # yields tuples of (table_name, loaded) as the tables are streamed from the extractors directly to the DB
+    for table_name, rows in extract_data.stream(log, only_table_name=only_table_name, cache=cache, only_table_types=only_table_types, csv_snapshot=csv_snapshot,
+                                                force=force, source_versions=source_versions):
+        log(f'Streaming {table_name}')
+        yield load_table_or_raise(table_name, force=force, rows=rows, source_versions=source_versions)
+
+
+def iterate_pipelined_load_tables(log, only_table_name=None, cache=None, only_table_types=None, loader=None, jobs=1, force=False, queue_size=None,
+                                  source_versions=None):
+    # extraction producers (one per table type) put the extracted table names in a bounded queue
+    # loader consumers take the table names from the queue and load them, so extraction and loading run at the same time
+    # yields tuples of (table_name, loaded) as the tables are loaded
+    table_types = [t for t in extract_data.EXTRACT_TABLE_TYPES if not only_table_types or t in only_table_types]
+    table_names_queue = queue.Queue(maxsize=queue_size or jobs)
+    results_queue = queue.Queue()
+    stop_event = threading.Event()
+    done = object()
+
+    def queue_put(item):
+        while not stop_event.is_set():
+            try:
+                table_names_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def extract_producer(table_type):
+        try:
+            for table_name in iterate_extract_table_names(log, only_table_name=only_table_name, cache=cache, only_table_types=[table_type],
+                                                          force=force, source_versions=source_versions):
+                if not queue_put(table_name):
+                    break
+        except Exception as e:
+            error = Exception(f'Failed to extract {table_type} tables')
+            error.__cause__ = e
+            results_queue.put(error)
+
+    def load_consumer():
+        while not stop_event.is_set():
+            try:
+                table_name = table_names_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if table_name is None:
+                break
+            try:
+                results_queue.put(load_table_or_raise(table_name, loader=loader, force=force, source_versions=source_versions))
+            except Exception as e:
+                results_queue.put(e)
+
+    def coordinator(producers, consumers):
+        wait(producers)
+        for _ in consumers:
+            queue_put(None)
+        wait(consumers)
+        results_queue.put(done)
+
+    with ThreadPoolExecutor(max_workers=len(table_types) + jobs + 1) as executor:
+        try:
+            producers = [executor.submit(extract_producer, table_type) for table_type in table_types]
+            consumers = [executor.submit(load_consumer) for _ in range(jobs)]
+            executor.submit(coordinator, producers, consumers)
+            while True:
+                result = results_queue.get()
+                if result is done:
+                    break
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
+        finally:
+            stop_event.set()
+
+
+def update_view(log, name, table, force=False):
+    # returns False if the view was skipped because none of the tables it unions changed since it was last updated
+    tables_start_with = table['tables_start_with']
+    view_table_names = [n for n in config.EXTRACT_DATA_TABLES.keys() if n.startswith(tables_start_with) and n != name]
+    sql = f'drop table if exists __temp__{name};\n'
+    sql += f'create table __temp__{name} as\n'
+    for i, view_table_name in enumerate(view_table_names):
+        if i > 0:
+            sql += 'union all\n'
+        sql += f'select * from {view_table_name}\n'
+    sql += ';\n'
+    sql += f'drop table if exists {name};\n'
+    sql += f'alter table __temp__{name} rename to {name};\n'
+    with get_db_engine().connect() as conn:
+        with conn.begin():
+            content_hash = tables_registry.get_tables_hash(conn, view_table_names, extra=table)
+            if not force and tables_registry.is_table_unchanged(conn, name, content_hash):
+                log(f'Skipped unchanged view {name}')
+                return False
+            conn.execute(sql)
+            tables_registry.update_table(conn, name, content_hash, conn.execute(f'select count(1) from {name}').scalar())
+    log(f'Updated view {name}')
+    return True
+
 
+def iterate_extract_table_names(log, only_table_name=None, cache=None, only_table_types=None, force=False, source_versions=None):
+    for table_name in extract_data.main(log, only_table_name=only_table_name, cache=cache, only_table_types=only_table_types,
+                                        force=force, source_versions=source_versions):
+        log(f'Extracted {table_name}')
+        yield table_name
 
-def main(log, extract=False, only_table_name=None, cache=None, only_table_types=None):
+
+def iterate_load_table_names(only_table_name=None, only_table_types=None):
+    for table_name, table_config in config.EXTRACT_DATA_TABLES.items():
+        if table_config['type'] == 'view':
+            continue
+        if only_table_types and table_config['type'] not in only_table_types:
+            continue
+        if only_table_name is None or only_table_name == table_name:
+            yield table_name
+
+
+def main(log, extract=False, only_table_name=None, cache=None, only_table_types=None, loader=None, jobs=1, force=False, pipeline=False,
+         stream=False, skip_csv_snapshot=False):
     if only_table_types:
         only_table_types = [t.strip() for t in only_table_types.split(',') if t.strip()]
-    if extract:
-        for table_name in extract_data.main(log, only_table_name=only_table_name, cache=cache, only_table_types=only_table_types):
-            log(f'Extracted {table_name}')
-            load_table(table_name)
-            yield table_name
+    tables_registry.run_migrations()
+    # filled by the extractors with the source versions of tables which support incremental extraction
+    source_versions = {} if extract else None
+    if extract and stream:
+        assert not pipeline and jobs == 1, 'stream does not support pipeline or jobs'
+        assert (loader or config.LOAD_DATA_LOADER) == 'copy', 'stream is supported only with the copy loader'
+        tables_loaded = iterate_stream_load_tables(log, only_table_name=only_table_name, cache=cache, only_table_types=only_table_types, force=force, csv_snapshot=not skip_csv_snapshot,
+                                                   source_versions=source_versions)
+    elif extract and pipeline:
+        tables_loaded = iterate_pipelined_load_tables(log, only_table_name=only_table_name, cache=cache, only_table_types=only_table_types, loader=loader, jobs=jobs, force=force,
+                                                      source_versions=source_versions)
     else:
-        for table_name, table_config in config.EXTRACT_DATA_TABLES.items():
-            if table_config['type'] == 'view':
-                continue
-            if only_table_types and table_config['type'] not in only_table_types:
-                continue
-            if only_table_name is None or only_table_name == table_name:
-                load_table(table_name)
-                yield table_name
+        assert not pipeline and not stream, 'pipeline and stream are supported only with extract'
+        if extract:
+            table_names = iterate_extract_table_names(log, only_table_name=only_table_name, cache=cache, only_table_types=only_table_types,
+                                                      force=force, source_versions=source_versions)
+        else:
+            table_names = iterate_load_table_names(only_table_name=only_table_name, only_table_types=only_table_types)
+        tables_loaded = iterate_load_tables(table_names, loader=loader, jobs=jobs, force=force, source_versions=source_versions)
+    loaded_table_names, skipped_table_names = [], []
+    # views are updated only after all tables were loaded, because they union the loaded tables
+    for table_name, loaded in tables_loaded:
+        if loaded:
+            log(f'Loaded table {table_name}')
+            loaded_table_names.append(table_name)
+        else:
+            log(f'Skipped loading unchanged table {table_name}')
+            skipped_table_names.append(table_name)
+        yield table_name
+    # tables which were not extracted because their source was not modified since the last load
+    for table_name in (source_versions or {}):
+        if table_name not in loaded_table_names and table_name not in skipped_table_names:
+            log(f'Skipped extracting unmodified table {table_name}')
+            skipped_table_names.append(table_name)
+            yield table_name
     for name, table in config.EXTRACT_DATA_TABLES.items():
         if only_table_types and table['type'] not in only_table_types:
             continue
         if only_table_name is None or only_table_name == name:
             if table['type'] == 'view':
-                tables_start_with = table['tables_start_with']
-                view_table_names = [n for n in config.EXTRACT_DATA_TABLES.keys() if n.startswith(tables_start_with) and n != name]
-                sql = f'drop table if exists __temp__{name};\n'
-                sql += f'create table __temp__{name} as\n'
-                for i, view_table_name in enumerate(view_table_names):
-                    if i > 0:
-                        sql += 'union all\n'
-                    sql += f'select * from {view_table_name}\n'
-                sql += ';\n'
-                sql += f'drop table if exists {name};\n'
-                sql += f'alter table __temp__{name} rename to {name};\n'
-                with get_db_engine().connect() as conn:
-                    with conn.begin():
-                        conn.execute(sql)
-                log(f'Updated view {name}')
-
-
-def ensure_updated_tables(log, table_names):
+                if update_view(log, name, table, force=force):
+                    loaded_table_names.append(name)
+                else:
+                    skipped_table_names.append(name)
+    log(f'Loaded {len(loaded_table_names)} tables, skipped {len(skipped_table_names)} unchanged tables')
+    if skipped_table_names:
+        log(f'Skipped unchanged tables: {", ".join(skipped_table_names)}')
+
+
+def ensure_updated_table(log, table_name, cache):
+    log(f'Updating table {table_name}...')
+    i = 0
+    updated_table_names = []
+    while True:
+        i += 1
+        try:
+            updated_table_names = list(main(log, extract=True, only_table_name=table_name, cache=cache))
+            break
+        except:
+            if i > 3:
+                raise
+            else:
+                log(traceback.format_exc())
+                log(f'Failed to update table {table_name}, retrying ({i})...')
+                time.sleep(random.randint(2, 10))
+    assert len(updated_table_names) == 1, updated_table_names
+    assert updated_table_names[0] == table_name, updated_table_names
+    log(f'OK ({table_name})')
+
+
+def ensure_updated_tables(log, table_names, jobs=1):
     needs_skeelz_export = False
     for table_name in table_names:
         if config.EXTRACT_DATA_TABLES[table_name]['type'] == 'skeelz_export':
@@ -105,22 +462,16 @@ def ensure_updated_tables(log, table_names):
             break
     cache = {}
     with extract_data.get_extract_skeelz_exports_context(cache, needs_skeelz_export=needs_skeelz_export) as _:
-        for table_name in table_names:
-            log(f'Updating table {table_name}...')
-            i = 0
-            updated_table_names = []
-            while True:
-                i += 1
-                try:
-                    updated_table_names = list(main(log, extract=True, only_table_name=table_name, cache=cache))
-                    break
-                except:
-                    if i > 3:
-                        raise
-                    else:
-                        log(traceback.format_exc())
-                        log(f'Failed to update table {table_name}, retrying ({i})...')
-                        time.sleep(random.randint(2, 10))
-            assert len(updated_table_names) == 1, updated_table_names
-            assert updated_table_names[0] == table_name, updated_table_names
-            log('OK')
+        if jobs > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = {executor.submit(ensure_updated_table, log, table_name, cache): table_name for table_name in table_names}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        for f in futures:
+                            f.cancel()
+                        raise Exception(f'Failed to update table {futures[future]}') from e
+        else:
+            for table_name in table_names:
+                ensure_updated_table(log, table_name, cache)
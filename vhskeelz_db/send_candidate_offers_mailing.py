@@ -1,14 +1,22 @@
 import os
+import time
 import base64
 import datetime
+import threading
+import collections
+import urllib.error
 from textwrap import dedent
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
+import backoff
 import dataflows as df
+import python_http_client.exceptions
+from psycopg2.extras import execute_values
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Asm, Attachment, FileContent, FileName, FileType, Disposition
+from sendgrid.helpers.mail import Mail, Asm, Attachment, FileContent, FileName, FileType, Disposition, Personalization, To, Bcc
 
 from .db import get_db_engine
-from . import config, download_position_candidate_cv, load_data
+from . import config, common, download_position_candidate_cv, load_data, tables_registry, cv_cache, blocklists
 
 
 # we use this to ensure that the tables we use are updated before running
@@ -24,7 +32,8 @@ DEPENDANT_TABLES = {
     ]
 }
 
-FIT_PERCENTAGE_SQL = '''CAST(replace(ctp."Candidate-Position fit rate", '%%', '') AS FLOAT) / 100'''
+# derived column which is added when loading the table, see load_data.DEFAULT_TABLES_SCHEMAS
+FIT_PERCENTAGE_SQL = 'ctp.fit_percentage'
 
 
 def get_dry_run_save_path(mailing_type):
@@ -63,6 +72,12 @@ def run_migrations(log, mailing_type):
                     {extra_fields}
                 );
             '''))
+            # the status lookups are by the candidate / position key, the index is not unique because the table is also used
+            # as a log of the status changes (e.g. mails resent with --with-sent are logged again)
+            conn.execute(f'drop index if exists {table_name}_key_uidx')
+            conn.execute(f'create index if not exists {table_name}_key_idx on {table_name} (candidate_id, "positionOfferId", status)')
+            if mailing_type == 'new_position':
+                conn.execute(f'create index if not exists {table_name}_position_idx on {table_name} ("positionOfferId", status)')
     log('Migrations done.')
 
 
@@ -130,33 +145,30 @@ def get_where_sql(mailing_type):
     mailing_config = config.CANDIDATE_OFFERS_MAILING_CONFIG[mailing_type]
     if mailing_type == 'num_fits':
         return dedent(f'''
-            and ctp."Candidate-Position fit rate" != 'null' and ctp."Candidate-Position fit rate" is not null
+            and {FIT_PERCENTAGE_SQL} is not null
             and {FIT_PERCENTAGE_SQL} >= {mailing_config["medium_min_fit_percentage"]}
             and {FIT_PERCENTAGE_SQL} <= 1
-            and c."Candidate id" || '_' || ctp."Position Id" not in (
-                select candidate_id || '_' || "positionOfferId" 
-                from candidate_offers_num_fits_mailing_status
-                where status = 'sent'
+            and not exists (
+                select 1 from candidate_offers_num_fits_mailing_status s
+                where s.candidate_id = c."Candidate id" and s."positionOfferId" = ctp."Position Id" and s.status = 'sent'
             )
         ''')
     elif mailing_type == 'interested':
         return dedent('''
             and ctp."Candidate-Position interested" = '1'
-            and c."Candidate id" || '_' || ctp."Position Id" not in (
-                select candidate_id || '_' || "positionOfferId" 
-                from candidate_offers_interested_mailing_status
-                where status = 'sent'
+            and not exists (
+                select 1 from candidate_offers_interested_mailing_status s
+                where s.candidate_id = c."Candidate id" and s."positionOfferId" = ctp."Position Id" and s.status = 'sent'
             )
         ''')
     elif mailing_type == 'new_matches':
         return dedent(f'''
-            and ctp."Candidate-Position fit rate" != 'null' and ctp."Candidate-Position fit rate" is not null
+            and {FIT_PERCENTAGE_SQL} is not null
             and {FIT_PERCENTAGE_SQL} >= {mailing_config["min_fit_percentage"]}
             and {FIT_PERCENTAGE_SQL} <= 1
-            and c."Candidate id" || '_' || ctp."Position Id" not in (
-                select candidate_id || '_' || "positionOfferId" 
-                from candidate_offers_new_matches_mailing_status
-                where status = 'sent'
+            and not exists (
+                select 1 from candidate_offers_new_matches_mailing_status s
+                where s.candidate_id = c."Candidate id" and s."positionOfferId" = ctp."Position Id" and s.status = 'sent'
             )
         ''')
     else:
@@ -212,18 +224,23 @@ def get_mail_data(grouped_rows, mailing_type, log, skip_download_cvs=False):
                 'candidate_position_ids': [[row['candidate_id'], row['position_id']] for row in rows]
             })
     elif mailing_type == 'interested':
-        os.makedirs(os.path.join(config.DATA_DIR, 'candidate_offers_interested_mailing', 'cv'), exist_ok=True)
         position_candidate_ids = set()
         for rows in grouped_rows.values():
             for row in rows:
                 position_candidate_ids.add((row['position_id'], row['candidate_id']))
         if not skip_download_cvs and position_candidate_ids:
             download_cvs(position_candidate_ids, log)
+            # all the attachments are fetched concurrently before preparing the mails
+            cv_filenames = cv_cache.prefetch(log, position_candidate_ids)
+        else:
+            cv_filenames = {}
         for rows in grouped_rows.values():
             for row in rows:
-                cv_filename = os.path.join(config.DATA_DIR, 'candidate_offers_interested_mailing', 'cv', f'{row["position_id"]}_{row["candidate_id"]}.pdf')
-                if not skip_download_cvs and not download_position_candidate_cv.download_from_gcs(f'cv/{row["position_id"]}_{row["candidate_id"]}.pdf', cv_filename):
-                    cv_filename = None
+                # CVs are attached from the local CV cache, they are downloaded from GCS only if not cached or changed
+                if skip_download_cvs:
+                    cv_filename = cv_cache.get_cached_cv(row['position_id'], row['candidate_id'])
+                else:
+                    cv_filename = cv_filenames.get((row['position_id'], row['candidate_id']))
                 position_candidate_ids.add((row['position_id'], row['candidate_id']))
                 data.append({
                     "from_email": from_email,
@@ -288,173 +305,441 @@ def get_dynamic_template_data(mailing_type, row):
     return dynamic_template_data
 
 
-def send_mails(log, mailing_type, mail_data, allow_send, test_email_to, test_email_limit, test_email_update_db):
+def get_message(mailing_type, row, to_emails):
+    message = Mail(from_email=row['from_email'], to_emails=to_emails)
+    message.add_bcc(config.CANDIDATE_OFFERS_MAILING_CONFIG['bcc'])
+    message.dynamic_template_data = get_dynamic_template_data(mailing_type, row)
+    message.template_id = row['template_id']
+    if row.get('pdf_attachment_filename') and row.get('pdf_attachment_name'):
+        with open(row['pdf_attachment_filename'], 'rb') as f:
+            data = f.read()
+        encoded_file = base64.b64encode(data).decode()
+        message.attachment = Attachment(
+            FileContent(encoded_file),
+            FileName(row['pdf_attachment_name']),
+            FileType('application/pdf'),
+            Disposition('attachment')
+        )
+    message.asm = Asm(int(config.SENDGRID_UNSUSCRIBE_GROUP_ID))
+    return message
+
+
+def get_batch_message(mailing_type, mails):
+    # mails is a list of (row, to_emails), all rows should have the same batch key
+    # each mail is a personalization with its own recipients and dynamic template data
+    message = Mail(from_email=mails[0][0]['from_email'])
+    for i, (row, to_emails) in enumerate(mails):
+        personalization = Personalization()
+        for to_email in get_to_emails_list(to_emails):
+            personalization.add_to(To(to_email))
+        personalization.add_bcc(Bcc(config.CANDIDATE_OFFERS_MAILING_CONFIG['bcc']))
+        personalization.dynamic_template_data = get_dynamic_template_data(mailing_type, row)
+        message.add_personalization(personalization, index=i)
+    message.template_id = mails[0][0]['template_id']
+    message.asm = Asm(int(config.SENDGRID_UNSUSCRIBE_GROUP_ID))
+    return message
+
+
+def get_to_emails_list(to_emails):
+    # to_emails is a single email for some mailing types and a list of emails for others
+    return [to_emails] if isinstance(to_emails, str) else list(to_emails)
+
+
+def get_batch_key(row):
+    # mails with the same batch key can be sent in a single request, mails with attachments are sent separately
+    if row.get('pdf_attachment_filename') and row.get('pdf_attachment_name'):
+        return None
+    return row['from_email'], row['template_id']
+
+
+def iterate_send_batches(mails, batch_personalizations):
+    # yields lists of (row, to_emails) to send in a single request
+    # if batch_personalizations is set, mails with the same batch key are batched together
+    # up to SENDGRID_MAX_BATCH_RECIPIENTS recipients per batch, each mail's recipients are its to emails and the bcc
+    batches = {}
+    batches_num_recipients = {}
+    for row, to_emails in mails:
+        batch_key = get_batch_key(row) if batch_personalizations else None
+        if batch_key is None:
+            yield [(row, to_emails)]
+        else:
+            num_recipients = len(get_to_emails_list(to_emails)) + 1
+            if batch_key in batches and batches_num_recipients[batch_key] + num_recipients > config.SENDGRID_MAX_BATCH_RECIPIENTS:
+                yield batches.pop(batch_key)
+            if batch_key not in batches:
+                batches[batch_key] = []
+                batches_num_recipients[batch_key] = 0
+            batches[batch_key].append((row, to_emails))
+            batches_num_recipients[batch_key] += num_recipients
+    yield from batches.values()
+
+
+# each send thread uses its own client, the clients are reused for all the messages sent by the thread
+sendgrid_clients = threading.local()
+
+
+def get_sendgrid_client():
+    if not hasattr(sendgrid_clients, 'client'):
+        sendgrid_clients.client = SendGridAPIClient(config.SENDGRID_API_KEY)
+    return sendgrid_clients.client
+
+
+def is_sendgrid_error_permanent(e):
+    return isinstance(e, python_http_client.exceptions.HTTPError) and e.status_code != 429 and e.status_code < 500
+
+
+class MailSender:
+    # sends the mails concurrently, limited by SENDGRID_SEND_CONCURRENCY in-flight requests and SENDGRID_SEND_REQUESTS_PER_SECOND
+    # rate limited (429) and server errors are retried with exponential backoff
+    # after a failure the pending mails are not sent, and an exception is raised after the in-flight mails complete
+
+    def __init__(self, log, mailing_type):
+        self.log = log
+        self.mailing_type = mailing_type
+        self.rate_limiter = common.TokenBucket(config.SENDGRID_SEND_REQUESTS_PER_SECOND, capacity=config.SENDGRID_SEND_CONCURRENCY)
+        self.failed_event = threading.Event()
+        self.counters_lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.latencies = []
+
+    def on_backoff(self, details):
+        with self.counters_lock:
+            self.counters['retries'] += 1
+        self.log(f'Retrying send after error: {details["exception"]!r} (tries={details["tries"]}, wait={details["wait"]:.1f}s)')
+
+    def send_message(self, message):
+        @backoff.on_exception(
+            backoff.expo, (python_http_client.exceptions.HTTPError, urllib.error.URLError), max_tries=6,
+            giveup=is_sendgrid_error_permanent, on_backoff=self.on_backoff
+        )
+        def send():
+            self.rate_limiter.acquire()
+            get_sendgrid_client().send(message)
+
+        send()
+
+    def send(self, mails):
+        # mails is a list of (row, to_emails) which are sent in a single request
+        # returns the send latency in seconds, or None if the mails were not sent due to a previous failure
+        if self.failed_event.is_set():
+            return None
+        start_time = time.monotonic()
+        try:
+            if len(mails) == 1:
+                self.send_message(get_message(self.mailing_type, *mails[0]))
+            else:
+                self.send_message(get_batch_message(self.mailing_type, mails))
+        except Exception:
+            self.failed_event.set()
+            raise
+        return time.monotonic() - start_time
+
+    def log_counters(self):
+        latency = f', latency avg {sum(self.latencies) / len(self.latencies):.2f}s max {max(self.latencies):.2f}s' if self.latencies else ''
+        self.log(f'Sent {self.counters["sent"]} mails in {self.counters["requests"]} requests, {self.counters["failed"]} failed, '
+                 f'{self.counters["skipped"]} skipped, {self.counters["retries"]} retries{latency}')
+
+
+def send_mails(log, mailing_type, mail_data, allow_send, test_email_to, test_email_limit, test_email_update_db, batch_personalizations=False):
+    # mail_data may be a list or an iterator, it's consumed as the mails are sent so that only the in-flight mails are kept in memory
     if test_email_to == 'default':
         test_email_to = config.CANDIDATE_OFFERS_MAILING_CONFIG['default_test_email_to']
     if test_email_to:
         test_email_to = [e.strip() for e in test_email_to.split(',')]
-    log(f'Sending {len(mail_data)} mails for {mailing_type} (allow_send={allow_send}, test_email_to={test_email_to}, test_email_limit={test_email_limit}, test_email_update_db={test_email_update_db})')
+    num_mails = f'{len(mail_data)} ' if isinstance(mail_data, list) else ''
+    log(f'Sending {num_mails}mails for {mailing_type} (allow_send={allow_send}, test_email_to={test_email_to}, test_email_limit={test_email_limit}, test_email_update_db={test_email_update_db})')
     if allow_send:
         assert not test_email_to and not test_email_limit and not test_email_update_db
     else:
         assert test_email_to is not None
-    for i, row in enumerate(mail_data):
-        if not allow_send and test_email_limit is not None and i >= test_email_limit:
-            log(f'Breaking after {test_email_limit} test mails')
-            break
-        from_email = row['from_email']
-        to_emails = row['to_emails'] if allow_send else test_email_to
-        if to_emails:
-            template_id = row['template_id']
-            dynamic_template_data = get_dynamic_template_data(mailing_type, row)
-            log(f'Sending mail from {from_email} to {to_emails} with template_id {template_id} and dynamic_template_data {dynamic_template_data}')
-            message = Mail(from_email=from_email, to_emails=to_emails)
-            message.add_bcc(config.CANDIDATE_OFFERS_MAILING_CONFIG['bcc'])
-            message.dynamic_template_data = dynamic_template_data
-            message.template_id = template_id
-            if row.get('pdf_attachment_filename') and row.get('pdf_attachment_name'):
-                with open(row['pdf_attachment_filename'], 'rb') as f:
-                    data = f.read()
-                    f.close()
-                encoded_file = base64.b64encode(data).decode()
-                message.attachment = Attachment(
-                    FileContent(encoded_file),
-                    FileName(row['pdf_attachment_name']),
-                    FileType('application/pdf'),
-                    Disposition('attachment')
-                )
-            message.asm = Asm(int(config.SENDGRID_UNSUSCRIBE_GROUP_ID))
-            sendgrid_client = SendGridAPIClient(config.SENDGRID_API_KEY)
-            sendgrid_client.send(message)
+    mail_sender = MailSender(log, mailing_type)
+    errors = []
+
+    def iterate_mails():
+        for i, row in enumerate(mail_data):
+            if not allow_send and test_email_limit is not None and i >= test_email_limit:
+                log(f'Breaking after {test_email_limit} test mails')
+                break
+            to_emails = row['to_emails'] if allow_send else test_email_to
+            if to_emails:
+                log(f'Sending mail from {row["from_email"]} to {to_emails} with template_id {row["template_id"]} and dynamic_template_data {get_dynamic_template_data(mailing_type, row)}')
+                yield row, to_emails
+
+    def handle_result(future, batch):
+        try:
+            latency = future.result()
+        except Exception as e:
+            mail_sender.counters['failed'] += len(batch)
+            log(f'Failed to send {len(batch)} mails from {batch[0][0]["from_email"]} to {[to_emails for row, to_emails in batch]}: {e!r}')
+            errors.append(e)
+            return
+        if latency is None:
+            mail_sender.counters['skipped'] += len(batch)
+            return
+        mail_sender.counters['requests'] += 1
+        mail_sender.latencies.append(latency)
+        for row, to_emails in batch:
+            mail_sender.counters['sent'] += 1
+            log(f'Sent mail to {to_emails} in {latency:.2f}s')
+            # the status is updated only after the mail was sent successfully
             if allow_send or test_email_update_db:
                 log(f'Updating {len(row["candidate_position_ids"])} db statuses to sent')
-                db_insert_statuses(mailing_type, row['candidate_position_ids'], 'sent')
+                status_writer.add(row['candidate_position_ids'], 'sent')
+
+    with StatusWriter(log, mailing_type) as status_writer:
+        with ThreadPoolExecutor(max_workers=config.SENDGRID_SEND_CONCURRENCY, thread_name_prefix='sendgrid') as executor:
+            # the number of submitted requests is bounded, so that the mails are prepared only shortly before they are sent
+            futures = {}
+            for batch in iterate_send_batches(iterate_mails(), batch_personalizations):
+                if mail_sender.failed_event.is_set():
+                    break
+                if len(futures) >= config.SENDGRID_SEND_CONCURRENCY * 2:
+                    done_futures, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done_futures:
+                        handle_result(future, futures.pop(future))
+                futures[executor.submit(mail_sender.send, batch)] = batch
+            for future in as_completed(futures):
+                handle_result(future, futures[future])
+    mail_sender.log_counters()
+    if errors:
+        raise Exception(f'Failed to send {mail_sender.counters["failed"]} mails') from errors[0]
+
+
+class StatusWriter:
+    # buffers the mailing statuses and inserts them with multi-row inserts using a single connection for the whole run
+    # the buffer is written when reaching CANDIDATE_OFFERS_MAILING_STATUS_FLUSH_ROWS, every CANDIDATE_OFFERS_MAILING_STATUS_FLUSH_SECONDS
+    # from a timer thread (also while no mails are sent, e.g. while preparing the next chunk) and on exit (including on error)
+    # so that statuses of sent mails are not lost
+
+    def __init__(self, log, mailing_type):
+        self.log = log
+        self.table_name = get_db_status_table_name(mailing_type)
+        self.lock = threading.Lock()
+        self.rows = []
+        self.num_inserted_rows = 0
+        self.conn = None
+        self.stop_event = threading.Event()
+        self.timer_thread = threading.Thread(target=self._timer_flush, name='status-writer', daemon=True)
+
+    def __enter__(self):
+        self.timer_thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop_event.set()
+        self.timer_thread.join()
+        try:
+            self.flush()
+        finally:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        if self.num_inserted_rows:
+            self.log(f'Wrote {self.num_inserted_rows} db statuses to {self.table_name}')
+
+    def add(self, candidate_position_ids, status):
+        with self.lock:
+            self.rows += [(candidate_id, position_id, status) for candidate_id, position_id in candidate_position_ids]
+            if len(self.rows) >= config.CANDIDATE_OFFERS_MAILING_STATUS_FLUSH_ROWS:
+                self._flush()
+
+    def _timer_flush(self):
+        while not self.stop_event.wait(config.CANDIDATE_OFFERS_MAILING_STATUS_FLUSH_SECONDS):
+            try:
+                self.flush()
+            except Exception as e:
+                # the rows are kept in the buffer, they will be written by the next flush or on exit
+                self.log(f'Failed to write db statuses to {self.table_name}, will retry: {e!r}')
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.rows:
+            if self.conn is None:
+                self.conn = get_db_engine().connect()
+            num_inserted_rows = 0
+            try:
+                with self.conn.begin():
+                    cursor = self.conn.connection.cursor()
+                    try:
+                        # execute_values sets the rowcount only of the last page, so the pages are executed separately
+                        page_size = config.CANDIDATE_OFFERS_MAILING_STATUS_FLUSH_ROWS
+                        for i in range(0, len(self.rows), page_size):
+                            page = self.rows[i:i + page_size]
+                            execute_values(
+                                cursor,
+                                f'insert into {self.table_name} (candidate_id, "positionOfferId", status) values %s',
+                                page, page_size=len(page)
+                            )
+                            num_inserted_rows += cursor.rowcount
+                    finally:
+                        cursor.close()
+            except Exception:
+                # a new connection is used for the retry, in case this one is broken
+                self.conn.close()
+                self.conn = None
+                raise
+            self.num_inserted_rows += num_inserted_rows
+            self.rows = []
+
+
+def remove_blocklists(log, mailing_type, rows, blocked_counters=None):
+    # if blocked_counters is provided, the rows were already filtered by the blocklists in the query (except for the company emails)
+    # so only the emails blocklist is applied, and the blocked_counters are added to the logged counters
+    blocklist_index = blocklists.get_index(log, emails_only=blocked_counters is not None)
+    blocklist_index.counters.clear()
+    blocklist_index.counters.update(blocked_counters or {})
+    valid_rows = blocklist_index.filter_rows(rows, get_email_field(mailing_type))
+    blocklist_index.log_counters(log)
+    return valid_rows
 
 
-def db_insert_statuses(mailing_type, candidate_position_ids, status):
-    table_name = get_db_status_table_name(mailing_type)
+def get_candidate_position_rows_sql(conn, mailing_type, blocked_counters=None):
+    # if blocked_counters is provided, the blocklists are applied in the query and the blocked rows are counted in blocked_counters
+    # the company emails are not blocked by the query, because only the blocked emails should be removed, not the whole row
+    details_url_sql = config.CANDIDATE_POSITION_CV_URL_TEMPLATE.format(
+        position_id="' || ctp.\"Position Id\" || '",
+        candidate_id="' || c.\"Candidate id\" || '",
+    )
+    fit_desc_sql = get_fit_desc_sql(mailing_type)
+    where_sql = get_where_sql(mailing_type)
+    with_sql = f'''
+        with numbered_positions as (
+            select *, row_number() over (partition by "Position id" order by "Position id") as rn
+            from {DEPENDANT_TABLES['skeelz_export_positions']}
+            where "Position active status" = 'Open'
+        )
+    '''
+    from_sql = f'''
+        from
+            {DEPENDANT_TABLES['skeelz_export_candidates_to_positions']} ctp,
+            {DEPENDANT_TABLES['skeelz_export_candidates']} c,
+            numbered_positions p
+        where
+            ctp."Candidate Id" = c."Candidate id"
+            and ctp."Position Id" = p."Position id"
+            and p.rn = 1
+            {where_sql}
+    '''
+    if blocked_counters is None:
+        blocklist_where_sql = ''
+    else:
+        blocklist_conditions = blocklists.get_sql_conditions(
+            candidate_id_sql='c."Candidate id"', position_id_sql='ctp."Position Id"',
+            email_sql='c."Email"' if get_email_field(mailing_type) == 'candidate_email' else None
+        )
+        blocklist_where_sql = blocklists.get_sql_where(blocklist_conditions)
+        blocked_counters.update(
+            conn.execute(dedent(blocklists.get_sql_counts_query(blocklist_conditions, from_sql, with_sql))).first()._asdict()
+        )
+    sql = f'''
+        {with_sql}
+        select
+            c."Candidate id" candidate_id, ctp."Position Id" position_id,
+            c."Candidate first name" || ' ' || c."Candidate last name" candidate_name,
+            p."Company TA manager email" ta_emails,
+            p."Company TA manager first name" ta_firstnames,
+            p."Company TA manager last name" ta_lastnames,
+            p."Company name" company_name,
+            p."Position name" position_name,
+            {FIT_PERCENTAGE_SQL} fit_percentage,
+            p."City" city,
+            c."Email" email,
+            '{details_url_sql}' details_url,
+            {fit_desc_sql} fit_desc
+        {from_sql}
+        {blocklist_where_sql}
+    '''
+    return dedent(sql)
+
+
+def get_candidate_position_row(row):
+    return {
+        'candidate_id': row.candidate_id,
+        'position_id': row.position_id,
+        'candidate_name': row.candidate_name or '',
+        "company_name": row.company_name or '',
+        'company_emails_names': get_ta_emails_names(row.ta_emails, row.ta_firstnames, row.ta_lastnames),
+        'position_name': row.position_name or '',
+        'city': row.city or '',
+        'details_url': row.details_url,
+        'fit_desc': row.fit_desc,
+        'candidate_email': row.email,
+    }
+
+
+def get_candidate_position_rows(log, mailing_type, blocked_counters=None):
     with get_db_engine().connect() as conn:
         with conn.begin():
-            for candidate_id, position_id in candidate_position_ids:
-                conn.execute(f'''
-                    insert into {table_name} (candidate_id, "positionOfferId", status)
-                    values ('{candidate_id}', '{position_id}', '{status}')
-                ''')
+            log("Fetching candidate positions...")
+            sql = get_candidate_position_rows_sql(conn, mailing_type, blocked_counters)
+            # print(sql)
+            return [get_candidate_position_row(row) for row in conn.execute(sql)]
 
 
-def remove_blocklists(log, mailing_type, rows):
-    with get_db_engine().connect() as conn:
-        with conn.begin():
-            block_candidate_id_position_id = [
-                (row.candidate_id.strip(), row.position_id.strip())
-                for row in conn.execute(f'''select "Candidate_id" candidate_id, "Position_id" position_id from {DEPENDANT_TABLES['aggregation_candidate_positions']} where "Remove" = 'TRUE' ''')
-                if row.candidate_id and row.position_id
-            ]
-            log(f'Found {len(block_candidate_id_position_id)} block candidate_id_position_id')
-            block_candidate_id = [
-                row.candidate_id.strip()
-                for row in conn.execute(f'''select "Candidate_id" candidate_id from {DEPENDANT_TABLES['aggregation_candidates']} where "Remove_can" = 'TRUE' ''')
-                if row.candidate_id
-            ]
-            log(f'Found {len(block_candidate_id)} block candidate_id')
-            block_position_id = [
-                row.position_id.strip()
-                for row in conn.execute(f'''select "P_ID" position_id from {DEPENDANT_TABLES['aggregation_positions']} where "Remove_P" = 'TRUE' ''')
-                if row.position_id
-            ]
-            log(f'Found {len(block_position_id)} block position_id')
-            smoove_blocklist_emails = [
-                row.email.strip()
-                for row in conn.execute(f'select email from {DEPENDANT_TABLES["smoove_blocklist"]}')
-                if row.email
-            ]
-            log(f'Found {len(smoove_blocklist_emails)} smoove_blocklist_emails')
-    valid_rows = []
-    blocked_candidate_id_position_id = 0
-    blocked_candidate_id = 0
-    blocked_position_id = 0
-    blocked_smoove_email = 0
-    email_field = get_email_field(mailing_type)
-    for row in rows:
-        if (row['candidate_id'].strip(), row['position_id'].strip()) in block_candidate_id_position_id:
-            blocked_candidate_id_position_id += 1
-        elif row['candidate_id'].strip() in block_candidate_id:
-            blocked_candidate_id += 1
-        elif row['position_id'].strip() in block_position_id:
-            blocked_position_id += 1
-        elif email_field != 'company_emails_names' and row[email_field].strip() and row[email_field].strip() in smoove_blocklist_emails:
-            blocked_smoove_email += 1
-        else:
-            if email_field == 'company_emails_names':
-                new_email_names = {}
-                for email, name in row[email_field].items():
-                    if email.strip() and email.strip() in smoove_blocklist_emails:
-                        blocked_smoove_email += 1
-                    else:
-                        new_email_names[email.strip()] = name
-                row[email_field] = new_email_names
-            # a row with no emails is still valid because we might not send the email to these emails depending on other conditions later
-            valid_rows.append(row)
-    log(f'Blocked {blocked_candidate_id_position_id} candidate_id_position_id, {blocked_candidate_id} candidate_id, {blocked_position_id} position_id, {blocked_smoove_email} smoove emails')
-    return valid_rows
+# the rows are streamed ordered by these fields, all the rows of a group have the same values for them (see get_group_key)
+STREAM_ORDER_BY_SQL = {
+    'num_fits': 'ctp."Position Id"',
+    'interested': 'p."Company TA manager email"',
+    'new_matches': 'c."Email"',
+}
 
 
-def get_candidate_position_rows(log, mailing_type):
+def iterate_candidate_position_rows(log, mailing_type, blocked_counters=None):
+    # streams the rows using a server-side cursor, ordered by the group key
     with get_db_engine().connect() as conn:
         with conn.begin():
-            log("Fetching candidate positions...")
-            details_url_sql = config.CANDIDATE_POSITION_CV_URL_TEMPLATE.format(
-                position_id="' || ctp.\"Position Id\" || '",
-                candidate_id="' || c.\"Candidate id\" || '",
-            )
-            fit_desc_sql = get_fit_desc_sql(mailing_type)
-            where_sql = get_where_sql(mailing_type)
-            sql = f'''
-                with numbered_positions as (
-                    select *, row_number() over (partition by "Position id" order by "Position id") as rn
-                    from {DEPENDANT_TABLES['skeelz_export_positions']}
-                    where "Position active status" = 'Open'
-                )
-                select
-                    c."Candidate id" candidate_id, ctp."Position Id" position_id,
-                    c."Candidate first name" || ' ' || c."Candidate last name" candidate_name,
-                    p."Company TA manager email" ta_emails,
-                    p."Company TA manager first name" ta_firstnames,
-                    p."Company TA manager last name" ta_lastnames,
-                    p."Company name" company_name,
-                    p."Position name" position_name,
-                    {FIT_PERCENTAGE_SQL} fit_percentage,
-                    p."City" city,
-                    c."Email" email,
-                    '{details_url_sql}' details_url,
-                    {fit_desc_sql} fit_desc
-                from
-                    {DEPENDANT_TABLES['skeelz_export_candidates_to_positions']} ctp,
-                    {DEPENDANT_TABLES['skeelz_export_candidates']} c,
-                    numbered_positions p
-                where
-                    ctp."Candidate Id" = c."Candidate id"
-                    and ctp."Position Id" = p."Position id"
-                    and p.rn = 1
-                    {where_sql}
-            '''
-            # print(sql)
-            return [
-                {
-                    'candidate_id': row.candidate_id,
-                    'position_id': row.position_id,
-                    'candidate_name': row.candidate_name or '',
-                    "company_name": row.company_name or '',
-                    'company_emails_names': get_ta_emails_names(row.ta_emails, row.ta_firstnames, row.ta_lastnames),
-                    'position_name': row.position_name or '',
-                    'city': row.city or '',
-                    'details_url': row.details_url,
-                    'fit_desc': row.fit_desc,
-                    'candidate_email': row.email,
-                }
-                for row
-                in conn.execute(dedent(sql))
-            ]
+            log("Streaming candidate positions...")
+            sql = get_candidate_position_rows_sql(conn, mailing_type, blocked_counters) + f'order by {STREAM_ORDER_BY_SQL[mailing_type]}\n'
+            result = conn.execution_options(stream_results=True).execute(sql)
+            while True:
+                rows = result.fetchmany(config.CANDIDATE_OFFERS_MAILING_STREAM_CHUNK_ROWS)
+                if not rows:
+                    break
+                for row in rows:
+                    yield get_candidate_position_row(row)
+
+
+def iterate_stream_grouped_rows(log, mailing_type, only_candidate_position_ids=None, blocked_counters=None):
+    # yields (group_key, rows), a group is yielded once the streamed rows group key changes
+    blocklist_index = blocklists.get_index(log, emails_only=blocked_counters is not None)
+    blocklist_index.counters.clear()
+    num_rows, num_groups = 0, 0
+    group_key, group_rows = None, []
+    for row in iterate_candidate_position_rows(log, mailing_type, blocked_counters):
+        if only_candidate_position_ids and [row['candidate_id'], row['position_id']] not in only_candidate_position_ids:
+            continue
+        num_rows += 1
+        for row in blocklist_index.filter_rows([row], get_email_field(mailing_type)):
+            row_group_key = ';;'.join(get_group_key(row, mailing_type))
+            if group_rows and row_group_key != group_key:
+                num_groups += 1
+                yield group_key, group_rows
+                group_rows = []
+            group_key = row_group_key
+            group_rows.append(row)
+    if group_rows:
+        num_groups += 1
+        yield group_key, group_rows
+    log(f"Fetched {num_rows} candidate positions")
+    blocklist_index.counters.update(blocked_counters or {})
+    blocklist_index.log_counters(log)
+    log(f"Grouped to {num_groups} groups")
+
+
+def iterate_stream_mail_data(log, mailing_type, grouped_rows_iterator, skip_download_cvs=False):
+    # the mail data is prepared for chunks of groups, so that the CVs of a chunk are still downloaded concurrently
+    chunk_grouped_rows, num_chunk_rows = {}, 0
+    for group_key, rows in grouped_rows_iterator:
+        chunk_grouped_rows.setdefault(group_key, []).extend(rows)
+        num_chunk_rows += len(rows)
+        if num_chunk_rows >= config.CANDIDATE_OFFERS_MAILING_STREAM_CHUNK_ROWS:
+            yield from get_mail_data(chunk_grouped_rows, mailing_type, log, skip_download_cvs=skip_download_cvs)
+            chunk_grouped_rows, num_chunk_rows = {}, 0
+    if chunk_grouped_rows:
+        yield from get_mail_data(chunk_grouped_rows, mailing_type, log, skip_download_cvs=skip_download_cvs)
 
 
 def get_ta_emails_names(emails, firstnames, lastnames):
@@ -472,7 +757,8 @@ def get_ta_emails_names(emails, firstnames, lastnames):
     return emails_names
 
 
-def get_new_position_candidate_position_rows(log, with_sent=False):
+def get_new_position_candidate_position_rows(log, with_sent=False, blocked_counters=None):
+    # if blocked_counters is provided, the positions blocklist is applied in the query and the blocked rows are counted in blocked_counters
     with get_db_engine().connect() as conn:
         with conn.begin():
             log("Fetching candidate positions...")
@@ -480,12 +766,20 @@ def get_new_position_candidate_position_rows(log, with_sent=False):
                 extra_where = ''
             else:
                 extra_where = dedent('''
-                    and "Position id" not in (
-                        select "positionOfferId"
-                        from candidate_offers_new_position_mailing_status
-                        where status = 'sent'
+                    and not exists (
+                        select 1 from candidate_offers_new_position_mailing_status s
+                        where s."positionOfferId" = "Position id" and s.status = 'sent'
                     )
                 ''')
+            if blocked_counters is not None:
+                blocklist_conditions = blocklists.get_sql_conditions(position_id_sql='"Position id"')
+                from_sql = f'''
+                    from {DEPENDANT_TABLES['skeelz_export_positions']}
+                    where "Position active status" = 'Open'
+                        {extra_where}
+                '''
+                blocked_counters.update(conn.execute(dedent(blocklists.get_sql_counts_query(blocklist_conditions, from_sql))).first()._asdict())
+                extra_where += blocklists.get_sql_where(blocklist_conditions)
             return [
                 {
                     'candidate_id': '-',
@@ -512,29 +806,65 @@ def get_new_position_candidate_position_rows(log, with_sent=False):
             ]
 
 
+def get_mailing_config_hash_extra(mailing_type):
+    # the configuration which affects the mails, a change in it means the mailing should run even if the tables didn't change
+    return {
+        'mailing_config': config.CANDIDATE_OFFERS_MAILING_CONFIG.get(mailing_type),
+        'bcc': config.CANDIDATE_OFFERS_MAILING_CONFIG.get('bcc'),
+        'fit_percentages': config.CANDIDATE_OFFERS_MAILING_CONFIG.get('fit_percentages'),
+        'position_details_url_template': config.POSITION_DETAILS_URL_TEMPLATE,
+        'candidate_position_cv_url_template': config.CANDIDATE_POSITION_CV_URL_TEMPLATE,
+        'unsubscribe_group_id': config.SENDGRID_UNSUSCRIBE_GROUP_ID,
+    }
+
+
 def main(log, mailing_type, dry_run=False, allow_send=False, test_email_to=None, test_email_limit=None, test_email_update_db=False,
-         only_candidate_position_ids=None, ensure_updated_tables=False, with_sent=False, skip_download_cvs=False):
+         only_candidate_position_ids=None, ensure_updated_tables=False, with_sent=False, skip_download_cvs=False,
+         ensure_updated_tables_jobs=1, skip_if_unchanged=False, blocklist_in_sql=False, batch_personalizations=False, stream_rows=False):
     if with_sent:
         assert dry_run or not allow_send
     if ensure_updated_tables:
-        load_data.ensure_updated_tables(log, DEPENDANT_TABLES.keys())
+        load_data.ensure_updated_tables(log, DEPENDANT_TABLES.keys(), jobs=ensure_updated_tables_jobs)
     run_migrations(log, mailing_type)
-    if mailing_type == 'new_position':
-        rows = get_new_position_candidate_position_rows(log, with_sent)
+    if skip_if_unchanged:
+        assert not only_candidate_position_ids and not with_sent and not test_email_limit
+        tables_registry.run_migrations()
+        unchanged, tables_hash = tables_registry.get_consumer_unchanged_tables_hash(
+            f'send_candidate_offers_mailing_{mailing_type}', DEPENDANT_TABLES.values(), extra=get_mailing_config_hash_extra(mailing_type)
+        )
+        if unchanged:
+            log('Input tables did not change since last run, skipping')
+            return
     else:
-        rows = get_candidate_position_rows(log, mailing_type)
-        if only_candidate_position_ids:
-            rows = [row for row in rows if [row['candidate_id'], row['position_id']] in only_candidate_position_ids]
-    log(f"Fetched {len(rows)} candidate positions")
-    rows = remove_blocklists(log, mailing_type, rows)
-    grouped_rows = {}
-    for row in rows:
-        group_key = ';;'.join(get_group_key(row, mailing_type))
-        grouped_rows.setdefault(group_key, []).append(row)
-    log(f"Grouped to {len(grouped_rows)} groups")
-    mail_data = get_mail_data(grouped_rows, mailing_type, log, skip_download_cvs=skip_download_cvs)
+        tables_hash = None
+    blocked_counters = collections.Counter() if blocklist_in_sql else None
+    if stream_rows and mailing_type != 'new_position' and not dry_run:
+        # the rows are fetched, grouped and prepared as mail data while the mails are sent
+        mail_data = iterate_stream_mail_data(
+            log, mailing_type, iterate_stream_grouped_rows(log, mailing_type, only_candidate_position_ids, blocked_counters),
+            skip_download_cvs=skip_download_cvs
+        )
+    else:
+        if stream_rows:
+            log("Streaming is not supported for dry run or new_position mailing, fetching all rows")
+        if mailing_type == 'new_position':
+            rows = get_new_position_candidate_position_rows(log, with_sent, blocked_counters=blocked_counters)
+        else:
+            rows = get_candidate_position_rows(log, mailing_type, blocked_counters=blocked_counters)
+            if only_candidate_position_ids:
+                rows = [row for row in rows if [row['candidate_id'], row['position_id']] in only_candidate_position_ids]
+        log(f"Fetched {len(rows)} candidate positions")
+        rows = remove_blocklists(log, mailing_type, rows, blocked_counters=blocked_counters)
+        grouped_rows = {}
+        for row in rows:
+            group_key = ';;'.join(get_group_key(row, mailing_type))
+            grouped_rows.setdefault(group_key, []).append(row)
+        log(f"Grouped to {len(grouped_rows)} groups")
+        mail_data = get_mail_data(grouped_rows, mailing_type, log, skip_download_cvs=skip_download_cvs)
     if dry_run:
         log("Dry run, not sending emails")
         dry_run_save_rows(log, mailing_type, grouped_rows, mail_data)
     else:
-        send_mails(log, mailing_type, mail_data, allow_send, test_email_to, test_email_limit, test_email_update_db)
+        send_mails(log, mailing_type, mail_data, allow_send, test_email_to, test_email_limit, test_email_update_db, batch_personalizations)
+        if tables_hash and (allow_send or test_email_update_db):
+            tables_registry.set_consumer_processed(f'send_candidate_offers_mailing_{mailing_type}', tables_hash)
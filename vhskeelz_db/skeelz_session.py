@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import tempfile
+import threading
+
+import jwt
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
+
+from . import config, download_position_candidate_cv
+
+
+SESSION_FILENAME = os.path.join(config.DATA_DIR, 'skeelz_session.json')
+COOKIES_DOMAIN = 'skeelz.retrain.ai'
+TOKEN_COOKIE_NAMES = ['id_token', 'access_token']
+
+# the session cookies are shared by all the threads in the process and persisted in SESSION_FILENAME between runs
+session_lock = threading.Lock()
+session_cookies = None
+
+
+def check_cookies(cookies):
+    cookie_names = [c['name'] for c in cookies if c['domain'] == COOKIES_DOMAIN]
+    return 'id_token' in cookie_names and 'access_token' in cookie_names and '__rtr_sofi' in cookie_names and '__rtr_state' in cookie_names
+
+
+def get_cookies_expiry(cookies):
+    # returns the earliest expiry timestamp of the id_token / access_token JWTs, or None if it can't be determined
+    expiries = []
+    for cookie in cookies:
+        if cookie['domain'] == COOKIES_DOMAIN and cookie['name'] in TOKEN_COOKIE_NAMES:
+            try:
+                exp = jwt.decode(cookie['value'], options={'verify_signature': False}).get('exp')
+            except jwt.exceptions.DecodeError:
+                exp = None
+            if not exp:
+                return None
+            expiries.append(exp)
+    return min(expiries) if len(expiries) == len(TOKEN_COOKIE_NAMES) else None
+
+
+def is_valid_cookies(cookies):
+    if not cookies or not check_cookies(cookies):
+        return False
+    expiry = get_cookies_expiry(cookies)
+    return bool(expiry and expiry - time.time() > config.SKEELZ_SESSION_MIN_TTL_SECONDS)
+
+
+def load_persisted_cookies():
+    if os.path.exists(SESSION_FILENAME):
+        try:
+            with open(SESSION_FILENAME) as f:
+                return json.load(f)['cookies']
+        except (ValueError, KeyError):
+            return None
+    return None
+
+
+def save_persisted_cookies(cookies):
+    os.makedirs(os.path.dirname(SESSION_FILENAME), exist_ok=True)
+    # the file contains the session tokens, so it's readable only by the owner
+    fd = os.open(f'{SESSION_FILENAME}.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'cookies': cookies}, f)
+    os.replace(f'{SESSION_FILENAME}.tmp', SESSION_FILENAME)
+
+
+def login_get_cookies(log, driver):
+    driver.get(config.CANDIDATE_POSITION_CV_URL_TEMPLATE.format(position_id='', candidate_id=''))
+    download_position_candidate_cv.login(log, driver)
+    try:
+        WebDriverWait(driver, 20, poll_frequency=0.2).until(lambda _: check_cookies(driver.get_cookies()))
+    except TimeoutException:
+        pass
+    cookies = driver.get_cookies()
+    assert check_cookies(cookies)
+    return cookies
+
+
+def login(log, driver=None):
+    if driver is None:
+        with tempfile.TemporaryDirectory() as download_path:
+            with download_position_candidate_cv.driver_contextmanager(download_path, False, None, False) as driver:
+                return login_get_cookies(log, driver)
+    else:
+        return login_get_cookies(log, driver)
+
+
+def get_valid_cookies():
+    # returns the cached or persisted session cookies if they are not expired, without logging in
+    global session_cookies
+    with session_lock:
+        if not is_valid_cookies(session_cookies):
+            session_cookies = load_persisted_cookies()
+        return session_cookies if is_valid_cookies(session_cookies) else None
+
+
+def get_cookies(log, driver=None):
+    # returns valid session cookies, a browser login is done only if there are no cached or persisted unexpired cookies
+    # driver is optional, if not provided and login is needed a new browser is started for the login
+    global session_cookies
+    with session_lock:
+        if not is_valid_cookies(session_cookies):
+            session_cookies = load_persisted_cookies()
+            if is_valid_cookies(session_cookies):
+                log('Using persisted Skeelz session')
+            else:
+                log('Skeelz session is missing or expired, logging in')
+                session_cookies = login(log, driver)
+                save_persisted_cookies(session_cookies)
+        return session_cookies
+
+
+def invalidate(cookies):
+    # should be called when the server rejected the cookies, so that the next get_cookies call will login again
+    # cookies which were already replaced by another thread are ignored
+    global session_cookies
+    with session_lock:
+        if session_cookies is cookies:
+            session_cookies = None
+            if os.path.exists(SESSION_FILENAME):
+                os.remove(SESSION_FILENAME)
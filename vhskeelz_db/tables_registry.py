@@ -0,0 +1,122 @@
+import json
+import hashlib
+from textwrap import dedent
+
+from .db import get_db_engine
+
+
+def run_migrations():
+    with get_db_engine().connect() as conn:
+        with conn.begin():
+            conn.execute(dedent('''
+                create table if not exists tables_registry (
+                    table_name varchar(255) primary key,
+                    content_hash varchar(64) not null,
+                    num_rows integer,
+                    loaded_at timestamp not null default now()
+                );
+                alter table tables_registry add column if not exists source_version varchar(255);
+                create table if not exists tables_registry_consumers (
+                    consumer_name varchar(255) primary key,
+                    tables_hash varchar(64) not null,
+                    processed_at timestamp not null default now()
+                );
+            '''))
+
+
+def get_content_hash(table_config):
+    # the table config is part of the hash so that config changes cause the table to be reloaded
+    return hashlib.sha256(json.dumps(table_config, sort_keys=True).encode())
+
+
+def iterate_rows_update_content_hash(content_hash, rows):
+    for row in rows:
+        content_hash.update(json.dumps(row).encode())
+        content_hash.update(b'\n')
+        yield row
+
+
+def get_file_content_hash(table_config, file_path):
+    content_hash = get_content_hash(table_config)
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def is_table_unchanged(conn, table_name, content_hash):
+    row = conn.execute(dedent('''
+        select content_hash from tables_registry
+        where table_name = %s and to_regclass(%s) is not null
+    '''), (table_name, table_name)).first()
+    return bool(row and row.content_hash == content_hash)
+
+
+def update_table(conn, table_name, content_hash, num_rows, source_version=None):
+    conn.execute(dedent('''
+        insert into tables_registry (table_name, content_hash, num_rows, loaded_at, source_version)
+        values (%s, %s, %s, now(), %s)
+        on conflict (table_name) do update set content_hash = excluded.content_hash, num_rows = excluded.num_rows,
+                                               loaded_at = excluded.loaded_at, source_version = excluded.source_version
+    '''), (table_name, content_hash, num_rows, source_version))
+
+
+def update_table_source_version(conn, table_name, source_version):
+    conn.execute(
+        'update tables_registry set source_version = %s where table_name = %s',
+        (source_version, table_name)
+    )
+
+
+def get_source_versions(table_names):
+    # returns a dict of table name: source version of the last successful load, only for tables which exist in the DB
+    if not table_names:
+        return {}
+    with get_db_engine().connect() as conn:
+        with conn.begin():
+            return {
+                row.table_name: row.source_version
+                for row in conn.execute(dedent('''
+                    select table_name, source_version from tables_registry
+                    where table_name in %s and source_version is not null and to_regclass(table_name) is not null
+                '''), (tuple(table_names),))
+            }
+
+
+def get_tables_hash(conn, table_names, extra=None):
+    table_names = sorted(set(table_names))
+    content_hashes = {
+        row.table_name: row.content_hash
+        for row in conn.execute('select table_name, content_hash from tables_registry where table_name in %s', (tuple(table_names),))
+    } if table_names else {}
+    return hashlib.sha256(json.dumps([
+        [[table_name, content_hashes.get(table_name)] for table_name in table_names],
+        extra
+    ], sort_keys=True).encode()).hexdigest()
+
+
+def get_consumer_unchanged_tables_hash(consumer_name, table_names, extra=None):
+    # returns a tuple of (unchanged, tables_hash)
+    # unchanged is True if none of the tables changed since the last time consumer_name processed them
+    # extra - json serializable consumer configuration, a change in it is also considered as a change
+    # tables_hash should be passed to set_consumer_processed after the consumer successfully processed the tables
+    with get_db_engine().connect() as conn:
+        with conn.begin():
+            tables_hash = get_tables_hash(conn, table_names, extra=extra)
+            row = conn.execute(
+                'select tables_hash from tables_registry_consumers where consumer_name = %s', (consumer_name,)
+            ).first()
+    return bool(row and row.tables_hash == tables_hash), tables_hash
+
+
+def set_consumer_processed(consumer_name, tables_hash):
+    with get_db_engine().connect() as conn:
+        with conn.begin():
+            conn.execute(dedent('''
+                insert into tables_registry_consumers (consumer_name, tables_hash, processed_at)
+                values (%s, %s, now())
+                on conflict (consumer_name) do update set tables_hash = excluded.tables_hash, processed_at = excluded.processed_at
+            '''), (consumer_name, tables_hash))
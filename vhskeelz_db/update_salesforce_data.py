@@ -387,17 +387,17 @@ def update_candidate_cases(conn, sf_url, sf_token, log, dry_run, only_candidate_
         rows = list(conn.execute(f'''
             SELECT
                 {sql_fields},
-                CAST(REPLACE("Candidate-Position fit rate", '%%', '') AS numeric) candidate_position_fit_rate,
+                CAST(skeelz_export_candidates_to_positions.fit_percentage * 100 AS numeric) candidate_position_fit_rate,
                 salesforce_objects.salesforce_id salesforce_contact_id
             FROM skeelz_export_candidates_to_positions, salesforce_objects
             WHERE "Position Id" in (
                 select distinct "Position id" from skeelz_export_positions where "Position active status" = 'Open'
             )
             and "Candidate-Position interested" = '1'
-            and "Candidate Id" || '_' || "Position Id" in (
-                select candidate_id || '_' || "positionOfferId" 
-                from candidate_offers_interested_mailing_status
-                where salesforce_status is null or salesforce_status not in ('skip')
+            and exists (
+                select 1 from candidate_offers_interested_mailing_status s
+                where s.candidate_id = "Candidate Id" and s."positionOfferId" = "Position Id"
+                and (s.salesforce_status is null or s.salesforce_status not in ('skip'))
             )
             and salesforce_objects.object_type = 'candidate_contact'
             and salesforce_objects.vhskeelz_id = "Candidate Id"
@@ -1,5 +1,5 @@
 from .db import get_db_engine
-from . import config, common
+from . import config, common, tables_registry, blocklists
 
 
 VHSKEELZ_DB_API_GROUP_ID = 'dN7PqD'
@@ -34,6 +34,10 @@ def process_output_row(row):
     }
 
 
+# used to skip processing if the input tables did not change since the last run
+INPUT_TABLES = ['skeelz_export_candidates']
+
+
 def iterate_candidates():
     candidates = []
     with get_db_engine().connect() as conn:
@@ -47,15 +51,28 @@ def iterate_candidates():
     return candidates
 
 
-def main(log, only_emails=None, limit=None, debug=False):
+def main(log, only_emails=None, limit=None, debug=False, skip_if_unchanged=False, skip_blocklisted=False):
     if only_emails:
         only_emails = [e.strip() for e in only_emails.split(',') if e.strip()]
+    if skip_if_unchanged:
+        assert not only_emails and not limit
+        tables_registry.run_migrations()
+        input_tables = INPUT_TABLES + (blocklists.EMAIL_BLOCKLIST_TABLES if skip_blocklisted else [])
+        unchanged, tables_hash = tables_registry.get_consumer_unchanged_tables_hash('update_sender_candidates_mailing_list', input_tables)
+        if unchanged:
+            log(f'Input tables did not change since last run, skipping ({", ".join(input_tables)})')
+            return
+    else:
+        tables_hash = None
+    blocklist_index = blocklists.get_index(log, emails_only=True) if skip_blocklisted else None
     created_emails = set()
     requests_session = common.requests_session_retry(status_forcelist=(500, 502, 503, 504))
     for candidate in iterate_candidates():
         sender_candidate = process_output_row(candidate)
         if only_emails and sender_candidate['email'] not in only_emails:
             continue
+        elif blocklist_index and not blocklist_index.filter_emails([sender_candidate['email']]):
+            continue
         elif sender_candidate['email'] in created_emails:
             log(f'skipping duplicate email: {sender_candidate["email"]}')
             continue
@@ -82,4 +99,8 @@ def main(log, only_emails=None, limit=None, debug=False):
             raise
         if limit and len(created_emails) >= limit:
             break
+    if blocklist_index:
+        log(f'skipped {blocklist_index.counters["email"]} blocklisted emails')
     log(f'created {len(created_emails)} candidates')
+    if tables_hash:
+        tables_registry.set_consumer_processed('update_sender_candidates_mailing_list', tables_hash)